@@ -18,6 +18,7 @@ from __future__ import print_function
 
 import torch
 import torch.nn as nn
+from collections import OrderedDict
 from core.utils import box
 import numpy as np
 from torchvision.ops.boxes import batched_nms
@@ -26,44 +27,51 @@ class AnchorLayer(nn.Module):
     '''
     For one level of the pyramid: Manages One Grid (x,y,w,h)
     The anchors grid is (height, width, num_anchors_per_position, 4)
-    The grid is cached, but changes if featuremap size changes
+    The grids are cached per featuremap size (a few sizes are kept for multi-scale batches)
     '''
+    max_cache_size = 8
 
     def __init__(self, box_size=32, ratios=[1], scales=[1]):
         super(AnchorLayer, self).__init__()
         self.num_anchors = len(scales) * len(ratios)
         box_sizes = AnchorLayer.generate_anchors(box_size, ratios, scales)
         self.register_buffer("box_sizes", box_sizes.view(-1))
-        self.anchors = None
+        self._cache = OrderedDict()
 
     @staticmethod
     def generate_anchors(box_size, ratios, scales):
-        anchors = box_size * np.tile(scales, (2, len(ratios))).T
-        areas = anchors[:, 0] * anchors[:, 1]
-        anchors[:, 0] = np.sqrt(areas * np.repeat(ratios, len(scales)))
-        anchors[:, 1] = anchors[:, 0] / np.repeat(ratios, len(scales))
-        return torch.from_numpy(anchors).float().contiguous()
-
-    def make_grid(self, height, width, stride):
-
-        grid_h, grid_w = torch.meshgrid([torch.linspace(0.5 * stride, (height - 1 + 0.5) * stride, height),
-                                         torch.linspace(0.5 * stride, (width - 1 + 0.5) * stride, width)
-                                         ])
-        grid = torch.cat([grid_w[..., None], grid_h[..., None]], dim=-1)
+        # (w, h) = box_size * scale * (sqrt(ratio), 1/sqrt(ratio)), ratio-major order
+        scales = torch.as_tensor(scales, dtype=torch.float64)
+        sqrt_ratios = torch.as_tensor(ratios, dtype=torch.float64).sqrt()
+        sizes = box_size * scales[None, :]
+        ws = (sizes * sqrt_ratios[:, None]).reshape(-1)
+        hs = (sizes / sqrt_ratios[:, None]).reshape(-1)
+        return torch.stack([ws, hs], dim=1).float()
+
+    def make_grid(self, height, width, stride, device=None, dtype=None):
+        ys = torch.linspace(0.5 * stride, (height - 1 + 0.5) * stride, height, device=device, dtype=dtype)
+        xs = torch.linspace(0.5 * stride, (width - 1 + 0.5) * stride, width, device=device, dtype=dtype)
+        grid_h, grid_w = torch.meshgrid(ys, xs, indexing='ij')
+        grid = torch.stack([grid_w, grid_h], dim=-1)
 
         grid = grid[:, :, None, :].expand(height, width, self.num_anchors, 2)
         return grid
 
     def forward(self, x, stride):
         height, width = x.shape[-2:]
-        if self.anchors is None or self.anchors.shape[0] != height or self.anchors.shape[1] != width or self.anchors.device != x.device:
-            grid = self.make_grid(height, width, stride).to(x.device)
-            wh = torch.zeros((self.num_anchors * 2, height, width), dtype=x.dtype, device=x.device) + \
-                self.box_sizes.view(self.num_anchors * 2, 1, 1)
-            wh = wh.permute([1, 2, 0]).view(height, width, self.num_anchors, 2)
-            self.anchors = torch.cat([grid, wh], dim=-1)
+        key = (height, width, stride, x.device, x.dtype)
+        anchors = self._cache.get(key)
+        if anchors is None:
+            grid = self.make_grid(height, width, stride, x.device, x.dtype)
+            wh = self.box_sizes.to(x.dtype).view(1, 1, self.num_anchors, 2).expand(height, width, self.num_anchors, 2)
+            anchors = torch.cat([grid, wh], dim=-1).view(-1, 4)
+            self._cache[key] = anchors
+            if len(self._cache) > self.max_cache_size:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(key)
 
-        return self.anchors.view(-1, 4)
+        return anchors
 
 
 class Anchors(nn.Module):
@@ -93,23 +101,29 @@ class Anchors(nn.Module):
         self.anchors = None
         self.anchors_xyxy = None
         self.idxs = None
-        self.last_shapes = []
+        self._anchor_cache = OrderedDict()
         self.decode_func = self.batched_decode
         self.max_decode = kwargs.get("max_decode", False)
 
     def forward(self, features, imsize):
-        shapes = [item.shape for item in features]
-        strides = [int(imsize[-1] / shape[-1]) for shape in shapes]
-        lengths = [shape[-1]*shape[-2]*self.num_anchors for shape in shapes]
+        shapes = tuple(tuple(item.shape[-2:]) for item in features)
+        strides = tuple(int(imsize[-1] / shape[-1]) for shape in shapes)
         assert len(self.anchor_generators) == len(features)
-        if self.anchors is None or shapes != self.last_shapes:
+        key = (shapes, strides, features[0].device, features[0].dtype)
+        cached = self._anchor_cache.get(key)
+        if cached is None:
             default_boxes = []
             for feature_map, anchor_layer, stride in zip(features, self.anchor_generators, strides):
                 anchors = anchor_layer(feature_map, stride)
                 default_boxes.append(anchors)
-            self.anchors = torch.cat(default_boxes, dim=0)
-            self.anchors_xyxy = box.change_box_order(self.anchors, "xywh2xyxy")
-        self.last_shapes = shapes
+            anchors = torch.cat(default_boxes, dim=0)
+            cached = (anchors, box.change_box_order(anchors, "xywh2xyxy"))
+            self._anchor_cache[key] = cached
+            if len(self._anchor_cache) > AnchorLayer.max_cache_size:
+                self._anchor_cache.popitem(last=False)
+        else:
+            self._anchor_cache.move_to_end(key)
+        self.anchors, self.anchors_xyxy = cached
         return self.anchors, self.anchors_xyxy
 
     # @cuda_time
@@ -79,9 +79,8 @@ class ConvPlastic(RNNCell):
 
     def forward(self, xi):
         xi = self.conv_x2h(xi)
-        xiseq = xi.split(1, 0)  # t,n,c,h,w
 
-        T, N, C, H, W = xi.shape
+        T, N, C, H, W = xi.shape  # t,n,c,h,w
         L = N*H*W
 
         if self.prev_h is not None:
@@ -91,14 +90,12 @@ class ConvPlastic(RNNCell):
             self.prev_h = torch.zeros(N, C, H, W).float().to(xi)
             self.hebb = torch.zeros(N, self.C, self.C, self.K, self.K).float().to(xi)
 
-        result = []
-        for t, xt in enumerate(xiseq):
-            xt = xt.squeeze(0)
-            self.prev_h, self.hebb = self.forward_t(xt, self.prev_h, self.hebb)
-            result.append(self.prev_h.unsqueeze(0))
-        
-        res = torch.cat(result, dim=0)
-        return res
+        result = xi.new_empty((T, N, C, H, W))
+        for t in range(T):
+            self.prev_h, self.hebb = self.forward_t(xi[t], self.prev_h, self.hebb)
+            result[t] = self.prev_h
+
+        return result
 
     def forward_t(self, xt, hin, hebb):
         weights = hebb * self.alpha.unsqueeze(0) + self.fixed_weights
@@ -23,11 +23,10 @@ def sigmoid_focal_loss(x, y, reduction='none'):
     s = x.sigmoid()
     batchsize, num_classes, height, width = x.shape
 
-    y2 = y.unsqueeze(2)
+    y2 = y.unsqueeze(1).long()
     fg = (y2>0).to(x)
     y_index = (y2 - 1).clamp_(0)
-    t = torch.zeros((batchsize, num_anchors, height, width), dtype=x.dtype, device=x.device)
-    t.scatter_(2, y_index, fg)
+    t = x.new_zeros(x.shape).scatter_(1, y_index, fg)
 
     pt = (1 - s) * t + s * (1 - t)
     focal_weight = (alpha * t + (1 - alpha) *
@@ -37,7 +36,7 @@ def sigmoid_focal_loss(x, y, reduction='none'):
 
     loss = F.binary_cross_entropy_with_logits(
         x, t, reduction='none') * focal_weight
-    loss = loss.sum(dim=-1)
+    loss = loss.sum(dim=1)
     loss[y < 0] = 0
 
     loss = reduce(loss, reduction)
@@ -91,6 +90,7 @@ class MaskDetector(nn.Module):
         loss_dict = {'semantics': semantics}
         return loss_dict
 
+    @torch.no_grad()
     def get_boxes(self, x, score_thresh=0.4):
         masks = self(x).sigmoid()
         targets = self.find_boxes(masks)
@@ -6,6 +6,7 @@ import sys
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from core.modules import ConvALSTMCell
 
 
 def reduce(loss, mode='none'):
@@ -34,9 +35,9 @@ def attention_loss(feature_extractor, x, targets, resize, box_drawing):
     masks = box_drawing(targets, x.shape[-2], x.shape[-1], 8)
     masks = torch.from_numpy(masks)[:,:,None,:,:].to(x)
     total_loss = 0
-    for module in self.feature_extractor.conv2.modules():
+    for module in feature_extractor.conv2.modules():
         if isinstance(module, ConvALSTMCell):
-            gate_a = torch.cat(module.gate_a)
+            gate_a = module.gate_a
             mask_a = resize(masks, gate_a)
             #Apply Binary Cross-Entropy
             loss_ = nn.functional.binary_cross_entropy_with_logits(
@@ -56,22 +57,35 @@ def softmax_focal_loss(x, y, reduction='none'):
     alpha = 0.25
     gamma = 2.0
     num_classes = x.size(-1)
-    x = x.view(-1, num_classes)
-    y = y.view(-1)
-    r = torch.arange(x.size(0))
-    ce = F.log_softmax(x, dim=-1)[r, y.clamp_(0)]
-    pt = torch.exp(ce)
+    x = x.reshape(-1, num_classes)
+    y = y.reshape(-1)
+    ce = F.cross_entropy(x, y, ignore_index=-1, reduction='none')
+    pt = torch.exp(-ce)
     weights = (1-pt).pow(gamma)
 
     # alpha version
     # p = y > 0
     # weights = (alpha * p + (1 - alpha) * (1 - p)) * weights.pow(gamma)
 
-    loss = -(weights * ce)
-    loss[y < 0] = 0
+    loss = weights * ce
     return reduce(loss, reduction)
 
 
+@torch.jit.script
+def _sigmoid_focal_term(x, t, alpha: float, gamma: float):
+    ''' elementwise sigmoid focal loss, log-probabilities via softplus
+
+    :param x: logits
+    :param t: binary targets (same shape as x)
+    :return: loss (same shape as x)
+    '''
+    p = torch.sigmoid(x)
+    pt = p * t + (1 - p) * (1 - t)
+    log_pt = -F.softplus(-x) * t - F.softplus(x) * (1 - t)
+    focal_weight = (alpha * t + (1 - alpha) * (1 - t)) * (1 - pt).pow(gamma)
+    return -focal_weight * log_pt
+
+
 def sigmoid_focal_loss(x, y, reduction='none'):
     ''' sigmoid focal loss
 
@@ -82,24 +96,13 @@ def sigmoid_focal_loss(x, y, reduction='none'):
     '''
     alpha = 0.25
     gamma = 2.0
-    s = x.sigmoid()
-    batchsize, num_anchors, num_classes = x.shape
-    
 
     y2 = y.unsqueeze(2)
     fg = (y2>0).to(x)
     y_index = (y2 - 1).clamp_(0)
-    t = torch.zeros((len(x), num_anchors, num_classes), dtype=x.dtype, device=x.device)
-    t.scatter_(2, y_index, fg)
-
-    pt = (1 - s) * t + s * (1 - t)
-    focal_weight = (alpha * t + (1 - alpha) *
-                    (1 - t)) * pt.pow(gamma)
-
-    # focal_weight = pt.pow(gamma)
+    t = x.new_zeros(x.shape).scatter_(2, y_index, fg)
 
-    loss = F.binary_cross_entropy_with_logits(
-        x, t, reduction='none') * focal_weight
+    loss = _sigmoid_focal_term(x, t, alpha, gamma)
     loss = loss.sum(dim=-1)
     loss[y < 0] = 0
 
@@ -151,9 +154,11 @@ class DetectionLoss(nn.Module):
 
     def forward(self, loc_preds, loc_targets, cls_preds, cls_targets):
         pos = cls_targets > 0
-        num_pos = max(1, pos.sum().item())
+        num_pos = pos.sum().clamp(min=1).to(loc_preds.dtype)
         cls_loss = self.cls_loss_func(cls_preds, cls_targets, 'sum') / num_pos
 
-        mask = pos.unsqueeze(2).expand_as(loc_preds)  # [N,#anchors,4]
-        loc_loss = self.reg_loss_func(loc_preds[mask], loc_targets[mask].to(loc_preds), reduction='sum') / num_pos
+        idx = pos.reshape(-1).nonzero(as_tuple=True)[0]
+        loc_p = loc_preds.reshape(-1, 4).index_select(0, idx)
+        loc_t = loc_targets.reshape(-1, 4).index_select(0, idx).to(loc_preds)
+        loc_loss = self.reg_loss_func(loc_p, loc_t, reduction='sum') / num_pos
         return loc_loss, cls_loss
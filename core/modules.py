@@ -5,6 +5,7 @@ from __future__ import print_function
 import torch.nn as nn
 from torch.nn import functional as F
 import torch
+from typing import Optional, Tuple
 from core.utils.opts import time_to_batch, batch_to_time
 # from core.attention_conv import AttentionConv
 
@@ -35,12 +36,10 @@ class SequenceWise(nn.Module):
         return x
 
     def forward_sequential(self, x):
-        xiseq = x.split(1, 0)
         res = []
-        for t, xt in enumerate(xiseq):
-            y = self.module(xt[0])
-            res.append(y.unsqueeze(0))
-        return torch.cat(res, dim=0)
+        for t in range(len(x)):
+            res.append(self.module(x[t]))
+        return torch.stack(res, dim=0)
 
     def __repr__(self):
         tmpstr = self.__class__.__name__ + ' (\n'
@@ -53,24 +52,100 @@ class CoordConv(nn.Module):
     def __init__(self, in_channels, out_channels, conv_func, **kwargs):
         super(CoordConv, self).__init__()
         self.conv = conv_func(in_channels + 2, out_channels, **kwargs)
+        self._grid_cache = {}
+        self._grid_out_cache = {}
+
+    def get_grid(self, x):
+        """(1,2,H,W) coordinates grid, cached per featuremap size"""
+        key = (x.shape[2], x.shape[3], x.device, x.dtype)
+        grid = self._grid_cache.get(key)
+        if grid is None:
+            grid_h, grid_w = torch.meshgrid(torch.linspace(-1., 1., x.shape[2], device=x.device, dtype=x.dtype),
+                                            torch.linspace(-1., 1., x.shape[3], device=x.device, dtype=x.dtype),
+                                            indexing='ij')
+            grid = torch.cat((grid_h[None, None, :, :], grid_w[None, None, :, :]), 1)
+            self._grid_cache[key] = grid
+        return grid
+
+    def can_bake(self):
+        """plain zero-padded conv: linear in its input channels,
+        so the coordinates channels can be convolved separately"""
+        conv = self.conv
+        return type(conv) is nn.Conv2d and conv.groups == 1 and conv.padding_mode == 'zeros'
+
+    def get_grid_out(self, x):
+        """(1,C,H',W') conv of the coordinates channels alone (+ conv bias),
+        constant per featuremap size in eval, cached there when no gradient is needed
+        (keyed by the parameters versions: in-place edits such as load_state_dict invalidate it)"""
+        conv = self.conv
+        key = (x.shape[2], x.shape[3], x.device, x.dtype, conv.weight._version,
+               None if conv.bias is None else conv.bias._version)
+        grid_out = self._grid_out_cache.get(key)
+        if grid_out is None:
+            grid_out = F.conv2d(self.get_grid(x), conv.weight[:, -2:], conv.bias,
+                                conv.stride, conv.padding, conv.dilation)
+            if not self.training and not torch.is_grad_enabled():
+                # entries of older parameters versions are dropped
+                self._grid_out_cache = {k: v for k, v in self._grid_out_cache.items() if k[4:] == key[4:]}
+                self._grid_out_cache[key] = grid_out
+        return grid_out
+
+    def train(self, mode=True):
+        # weights may change
+        self._grid_out_cache.clear()
+        return super(CoordConv, self).train(mode)
 
     def forward(self, x):
-        grid_h, grid_w = torch.meshgrid([torch.linspace(-1, 1., x.shape[2]), torch.linspace(-1, 1., x.shape[3])])
-        grid = torch.cat((grid_h[None, None, :, :], grid_w[None, None, :, :]), 1).repeat(x.shape[0], 1, 1, 1)
-        ret = torch.cat((x, grid.to(x.device)), 1)
+        # split-weight conv: avoids the (N,C+2,H,W) cat, grid term recomputed while training
+        if self.can_bake():
+            conv = self.conv
+            ret = F.conv2d(x, conv.weight[:, :-2], None, conv.stride, conv.padding, conv.dilation)
+            return ret + self.get_grid_out(x)
+        grid = self.get_grid(x).expand(x.shape[0], -1, -1, -1)
+        ret = torch.cat((x, grid), 1)
         ret = self.conv(ret)
         return ret
 
 
 
 class SeparableConv2d(nn.Sequential):
-    def __init__(self, in_channels, out_channels, kernel_size=1, stride=1, padding=0, dilation=1, bias=False):
+    def __init__(self, in_channels, out_channels, kernel_size=1, stride=1, padding=0, dilation=1, bias=False,
+                 channels_last=False, inplace=False):
         super(SeparableConv2d, self).__init__(
             nn.Conv2d(in_channels, in_channels, kernel_size, stride, padding, dilation, groups=in_channels,
                       bias=bias),
             nn.Conv2d(in_channels, out_channels, 1, 1, 0, 1, 1, bias=bias)
         )
-        
+        # cudnn has fast nhwc depthwise kernels (mostly fp16, 3x3)
+        self.channels_last = channels_last
+        if channels_last:
+            self.to(memory_format=torch.channels_last)
+        # inference only: the depthwise result overwrites the input (the caller must not reuse it)
+        self.inplace = inplace
+
+    def forward(self, x):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        if self.inplace and not self.training and self.can_run_inplace(x):
+            return self.forward_inplace(x)
+        return super(SeparableConv2d, self).forward(x)
+
+    def can_run_inplace(self, x):
+        depthwise = self[0]
+        k, d, p = depthwise.kernel_size, depthwise.dilation, depthwise.padding
+        same_size = all(2 * p[i] == d[i] * (k[i] - 1) for i in range(2))
+        return depthwise.stride == (1, 1) and same_size and x.is_contiguous() and not torch.is_grad_enabled()
+
+    def forward_inplace(self, x):
+        """depthwise conv channel by channel written back into x, then pointwise:
+        only one channel is held on top of the input instead of a full depthwise output"""
+        depthwise, pointwise = self[0], self[1]
+        for c in range(x.shape[1]):
+            bias = None if depthwise.bias is None else depthwise.bias[c:c+1]
+            x[:, c:c+1] = F.conv2d(x[:, c:c+1], depthwise.weight[c:c+1], bias, 1,
+                                   depthwise.padding, depthwise.dilation)
+        return pointwise(x)
+
 
 class ConvLayer(nn.Sequential):
 
@@ -86,6 +161,26 @@ class ConvLayer(nn.Sequential):
             getattr(nn, activation)()
         )
 
+    @torch.no_grad()
+    def fuse_bn(self):
+        """Folds the (pre-conv) BatchNorm into the conv, for inference.
+        Only exact without zero-padding (padded borders are not normalized),
+        so it is applied to 1x1-like convs with padding=0 and groups=1."""
+        bn, conv = self[0], self[1]
+        if not isinstance(bn, nn.BatchNorm2d) or type(conv) is not nn.Conv2d:
+            return
+        if bn.training or any(conv.padding) or conv.groups != 1:
+            return
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        shift = bn.bias - bn.running_mean * scale
+        bias = conv.weight.sum(dim=(2, 3)) @ shift
+        if conv.bias is None:
+            conv.bias = nn.Parameter(bias)
+        else:
+            conv.bias += bias
+        conv.weight *= scale[None, :, None, None]
+        self[0] = nn.Identity()
+
 
 class Bottleneck(nn.Module):
     def __init__(self, in_planes, planes, stride=1):
@@ -96,7 +191,7 @@ class Bottleneck(nn.Module):
                                bias=False)
         self.conv3 = ConvLayer(in_channels=mid_planes, out_channels=planes, kernel_size=1, padding=0, bias=False)
 
-        self.downsample = nn.Sequential()
+        self.downsample = None
         if stride != 1 or in_planes != planes:
             self.downsample = ConvLayer(in_channels=in_planes, out_channels=planes,
                                      kernel_size=1, padding=0, stride=stride,
@@ -107,8 +202,8 @@ class Bottleneck(nn.Module):
         out = self.conv1(x)
         out = self.conv2(out)
         out = self.conv3(out)
-        out += self.downsample(x)
-        out = F.relu(out)
+        residual = x if self.downsample is None else self.downsample(x)
+        out = F.relu(out + residual)
         return out
 
 
@@ -118,7 +213,7 @@ class PreActBlock(nn.Module):
         self.conv1 = ConvLayer(in_planes, planes, kernel_size=3, stride=stride, padding=1, bias=False)
         self.conv2 = ConvLayer(planes, planes, kernel_size=3, stride=1, padding=1, bias=False)
 
-        self.downsample = nn.Sequential()
+        self.downsample = None
         if stride != 1 or in_planes != planes:
             self.downsample = nn.Sequential(
                 nn.Conv2d(in_planes, planes, kernel_size=1, stride=stride, bias=False)
@@ -139,8 +234,8 @@ class PreActBlock(nn.Module):
 
         # Excitation
         out = out * w
-        out += self.downsample(x) 
-        return out
+        residual = x if self.downsample is None else self.downsample(x)
+        return out + residual
         
 
 class ASPP(nn.Module):
@@ -154,15 +249,37 @@ class ASPP(nn.Module):
 
         self.convs = nn.ModuleList(modules)
         self.project = conv_func(in_channels * len(self.convs), out_channels, kernel_size=1, padding=0)
+        self._streams = {}
 
     def forward(self, x):
-        res = []
-        for conv in self.convs:
-            res.append(conv(x))
+        if x.is_cuda and not torch.is_grad_enabled():
+            res = self.forward_streams(x)
+        else:
+            res = []
+            for conv in self.convs:
+                res.append(conv(x))
         res = torch.cat(res, dim=1)
         res = self.project(res)
         return res
 
+    def forward_streams(self, x):
+        """Runs the dilated branches concurrently, one cuda stream each (inference only)"""
+        current = torch.cuda.current_stream(x.device)
+        streams = self._streams.get(x.device)
+        if streams is None:
+            streams = [torch.cuda.Stream(x.device) for _ in self.convs]
+            self._streams[x.device] = streams
+        res = []
+        for conv, stream in zip(self.convs, streams):
+            stream.wait_stream(current)
+            with torch.cuda.stream(stream):
+                x.record_stream(stream)
+                res.append(conv(x))
+        for y, stream in zip(res, streams):
+            current.wait_stream(stream)
+            y.record_stream(current)
+        return res
+
 
 def sequence_upsample(x, y):
     x, n = time_to_batch(x)
@@ -172,6 +289,83 @@ def sequence_upsample(x, y):
 
 
 
+@torch.jit.script
+def _hard_sigmoid(x):
+    return torch.clamp(x * 0.5 + 0.5, 0.0, 1.0)
+
+
+@torch.jit.script
+def _hard_tanh(x):
+    return torch.clamp(x, -1.0, 1.0)
+
+
+@torch.jit.script
+def _lstm_pointwise(tmp, prev_c: Optional[torch.Tensor], hidden_dim: int,
+                    hard: bool = False) -> Tuple[torch.Tensor, torch.Tensor]:
+    cc_i, cc_f, cc_o, cc_g = torch.split(tmp, hidden_dim, dim=1)
+    if hard:
+        i = _hard_sigmoid(cc_i)
+        f = _hard_sigmoid(cc_f)
+        o = _hard_sigmoid(cc_o)
+        g = _hard_tanh(cc_g)
+    else:
+        i = torch.sigmoid(cc_i)
+        f = torch.sigmoid(cc_f)
+        o = torch.sigmoid(cc_o)
+        g = torch.tanh(cc_g)
+    if prev_c is None:
+        c = i * g
+    else:
+        c = f * prev_c + i * g
+    if hard:
+        h = o * _hard_tanh(c)
+    else:
+        h = o * torch.tanh(c)
+    return h, c
+
+
+def _lstm_pointwise_inplace(tmp, prev_c: Optional[torch.Tensor], hidden_dim: int,
+                            hard: bool = False) -> Tuple[torch.Tensor, torch.Tensor]:
+    """same as _lstm_pointwise with in-place ops (addcmul_, mul_) and no temporaries,
+    overwrites tmp: only valid without autograd"""
+    cc_i, cc_f, cc_o, cc_g = torch.split(tmp, hidden_dim, dim=1)
+    sig = tmp[:, :3 * hidden_dim]
+    if hard:
+        sig.mul_(0.5).add_(0.5).clamp_(0.0, 1.0)
+        cc_g.clamp_(-1.0, 1.0)
+    else:
+        sig.sigmoid_()
+        cc_g.tanh_()
+    if prev_c is None:
+        c = torch.mul(cc_i, cc_g)
+    else:
+        c = torch.mul(cc_f, prev_c)
+        c.addcmul_(cc_i, cc_g)
+    h = torch.clamp(c, -1.0, 1.0) if hard else torch.tanh(c)
+    h.mul_(cc_o)
+    return h, c
+
+
+@torch.jit.script
+def _gru_gates(tmp, hidden_dim: int, bistable: bool = False, hard: bool = False) -> Tuple[torch.Tensor, torch.Tensor]:
+    cc_z, cc_r = torch.split(tmp, hidden_dim, dim=1)
+    if hard:
+        z = _hard_sigmoid(cc_z)
+        r = _hard_tanh(cc_r) + 1 if bistable else _hard_sigmoid(cc_r)
+    else:
+        z = torch.sigmoid(cc_z)
+        r = torch.tanh(cc_r) + 1 if bistable else torch.sigmoid(cc_r)
+    return z, r
+
+
+@torch.jit.script
+def _gru_update(z, tmp, prev_h: Optional[torch.Tensor], hard: bool = False):
+    tmp = _hard_tanh(tmp) if hard else torch.tanh(tmp)
+    if prev_h is None:
+        return z * tmp
+    return (1 - z) * prev_h + z * tmp
+
+
 class RNNCell(nn.Module):
     """
     base class that has memory, each class with hidden state has to derive from basernn
@@ -185,8 +379,11 @@ class RNNCell(nn.Module):
         self.saturation_limit = 1.05
         self.saturation_weight = 1e-1
         self.set_gates(hard)
+        self.use_cuda_graph = False
+        self._graphs = {}
 
     def set_gates(self, hard):
+        self.hard = hard
         if hard:
             self.sigmoid = self.hard_sigmoid
             self.tanh = self.hard_tanh
@@ -194,16 +391,19 @@ class RNNCell(nn.Module):
             self.sigmoid = torch.sigmoid
             self.tanh = torch.tanh
 
+    def track_saturation(self):
+        """the saturation cost is a training regularizer only"""
+        return self.training and self.saturation_weight > 0
+
     def hard_sigmoid(self, x_in):
-        self.add_saturation_cost(x_in)
-        x = x_in * 0.5 + 0.5
-        y = torch.clamp(x, 0.0, 1.0)
-        return y
+        if self.track_saturation():
+            self.add_saturation_cost(x_in)
+        return _hard_sigmoid(x_in)
 
     def hard_tanh(self, x):
-        self.add_saturation_cost(x)
-        y = torch.clamp(x, -1.0, 1.0)
-        return y
+        if self.track_saturation():
+            self.add_saturation_cost(x)
+        return _hard_tanh(x)
 
     def add_saturation_cost(self, var):
         """Calculate saturation cost."""
@@ -213,6 +413,81 @@ class RNNCell(nn.Module):
         cost *= self.saturation_weight
         self.saturation_cost += cost
 
+    def graphed(self, module, x):
+        """Runs module(x), replaying a captured cuda graph when enabled (no-grad only).
+        One graph is captured per (module, shape), the output buffer is reused by the next replay"""
+        if not (self.use_cuda_graph and x.is_cuda and not torch.is_grad_enabled()):
+            return module(x)
+        key = (id(module), tuple(x.shape), x.dtype, x.device)
+        entry = self._graphs.get(key)
+        if entry is None:
+            static_x = x.clone()
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(3):
+                    module(static_x)
+            torch.cuda.current_stream().wait_stream(stream)
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                static_y = module(static_x)
+            entry = (graph, static_x, static_y)
+            self._graphs[key] = entry
+        graph, static_x, static_y = entry
+        static_x.copy_(x)
+        graph.replay()
+        return static_y
+
+    def add_bias(self, module, x):
+        """x + module(0): when the hidden state is still 0 a plain conv reduces to its bias,
+        any other conv_func (separable, conv + bn + act...) is run on zeros.
+        Always a new tensor: the in-place gates may overwrite it (x can be the caller's input)"""
+        if type(module) is not nn.Conv2d:
+            return module(x.new_zeros((x.shape[0], self.hidden_dim) + x.shape[2:])) + x
+        if module.bias is None:
+            return x.clone()
+        return x + module.bias.view(1, -1, 1, 1)
+
+    def gru_gates(self, tmp, bistable=False):
+        """update & reset gates from their pre-activations [z, r],
+        bistable (nBRC) reset gate is tanh + 1 (in [0,2])"""
+        if not (self.hard and self.track_saturation()):
+            return _gru_gates(tmp, self.hidden_dim, bistable, self.hard)
+        cc_z, cc_r = torch.split(tmp, self.hidden_dim, dim=1)
+        z = self.sigmoid(cc_z)
+        r = self.tanh(cc_r) + 1 if bistable else self.sigmoid(cc_r)
+        return z, r
+
+    def gru_update(self, z, tmp, prev_h):
+        """h = (1-z) * prev_h + z * tanh(tmp)"""
+        if not (self.hard and self.track_saturation()):
+            return _gru_update(z, tmp, prev_h, self.hard)
+        tmp = self.tanh(tmp)
+        if prev_h is None:
+            return z * tmp
+        return (1-z) * prev_h + z * tmp
+
+    def lstm_update(self, tmp, prev_c):
+        """LSTM gates & state update from the pre-activations [i, f, o, g]
+        runs as one scripted (fusable) function,
+        except hard gates in training which stay eager to accumulate the saturation cost"""
+        if not (self.hard and self.track_saturation()):
+            if not torch.is_grad_enabled() and tmp.device.type == 'cpu':
+                # no cpu fuser: in-place elementwise ops instead
+                return _lstm_pointwise_inplace(tmp, prev_c, self.hidden_dim, self.hard)
+            return _lstm_pointwise(tmp, prev_c, self.hidden_dim, self.hard)
+        cc_i, cc_f, cc_o, cc_g = torch.split(tmp, self.hidden_dim, dim=1)
+        i = self.sigmoid(cc_i)
+        f = self.sigmoid(cc_f)
+        o = self.sigmoid(cc_o)
+        g = self.tanh(cc_g)
+        if prev_c is None:
+            c = i * g
+        else:
+            c = f * prev_c + i * g
+        h = o * self.tanh(c)
+        return h, c
+
     def reset(self):
         raise NotImplementedError()
 
@@ -241,55 +516,39 @@ class ConvLSTMCell(RNNCell):
         self.saturation_cost = 0
         inference = (len(xi.shape) == 4)  # inference for model conversion
         if inference:
-            xiseq = [xi]
-        else:
-            xiseq = xi.split(1, 0)  # t,n,c,h,w
+            xi = xi[None]  # t,n,c,h,w
 
-        if self.prev_h is not None:
+        if self.prev_h is not None and self.prev_h.requires_grad:
             self.prev_h = self.prev_h.detach()
             self.prev_c = self.prev_c.detach()
-        else:
-            shape = list(xiseq[0][0].shape)
-            shape[1] = self.hidden_dim
-            self.prev_h = torch.zeros(shape, dtype=torch.float32, device=xi.device)
-            self.prev_c = torch.zeros(shape, dtype=torch.float32, device=xi.device)
 
-        result = []
-        for t, xt in enumerate(xiseq):
-            if not inference:  # for training/val (not inference)
-                xt = xt.squeeze(0)
+        T, N, _, H, W = xi.shape
+        if not inference:
+            result = xi.new_empty((T, N, self.hidden_dim, H, W))
+        for t in range(T):
+            xt = xi[t]
 
             if self.prev_h is not None:
-                tmp = self.conv_h2h(self.prev_h) + xt
+                tmp = self.graphed(self.conv_h2h, self.prev_h) + xt
             else:
-                tmp = xt
-
-            cc_i, cc_f, cc_o, cc_g = torch.split(tmp, self.hidden_dim, dim=1)
-            i = self.sigmoid(cc_i)
-            f = self.sigmoid(cc_f)
-            o = self.sigmoid(cc_o)
-            g = self.tanh(cc_g)
-            if self.prev_c is None:
-                c = i * g
-            else:
-                c = f * self.prev_c + i * g
-            h = o * self.tanh(c)
+                tmp = self.add_bias(self.conv_h2h, xt)
+
+            h, c = self.lstm_update(tmp, self.prev_c)
             if not inference:
-                result.append(h.unsqueeze(0))
+                result[t] = h
             self.prev_h = h
             self.prev_c = c
         if inference:
-            res = h
-        else:
-            res = torch.cat(result, dim=0)
-        return res
+            return h
+        return result
 
     def reset(self, mask=None):
         """To be called in between batches"""
         if mask is None or self.prev_h is None:
             self.prev_h, self.prev_c = None, None
         else:
-            self.prev_h, self.prev_c = self.prev_h.detach(), self.prev_c.detach()
+            if self.prev_h.requires_grad:
+                self.prev_h, self.prev_c = self.prev_h.detach(), self.prev_c.detach()
             mask = mask.to(self.prev_h)
             self.prev_h *= mask
             self.prev_c *= mask
@@ -343,69 +602,53 @@ class ConvALSTMCell(RNNCell):
         self.saturation_cost = 0
         inference = (len(xi.shape) == 4)  # inference for model conversion
         if inference:
-            xiseq = [xi]
-        else:
-            xiseq = xi.split(1, 0)  # t,n,c,h,w
+            xi = xi[None]  # t,n,c,h,w
 
-        if self.prev_h is not None:
+        if self.prev_h is not None and self.prev_h.requires_grad:
             self.prev_h = self.prev_h.detach()
             self.prev_c = self.prev_c.detach()
-        else:
-            shape = list(xiseq[0][0].shape)
-            shape[1] = self.hidden_dim
-            self.prev_h = torch.zeros(shape, dtype=torch.float32, device=xi.device)
-            self.prev_c = torch.zeros(shape, dtype=torch.float32, device=xi.device)
 
-        self.gate_a = []
-        result = []
-        for t, xt in enumerate(xiseq):
-            if not inference:  # for training/val (not inference)
-                xt = xt.squeeze(0)
+        T, N, _, H, W = xi.shape
+        self.gate_a = xi.new_empty((T, N, 1, H, W))
+        if not inference:
+            result = xi.new_empty((T, N, self.hidden_dim, H, W))
+        for t in range(T):
+            xt = xi[t]
 
             # 1. Make A
             if self.prev_h is not None:
                 tmp = self.conv_x2a(xt) + self.conv_h2a(self.prev_h)
             else:
-                tmp = self.conv_x2a(xt)
+                tmp = self.add_bias(self.conv_h2a, self.conv_x2a(xt))
 
             a = tmp
 
-            self.gate_a.append(a[None]) #store gate_a for direct supervision!
+            self.gate_a[t] = a #store gate_a for direct supervision!
 
             a = torch.sigmoid(a)
             ax = a * xt
 
             if self.prev_h is not None:
-                tmp = self.conv_h2h(self.prev_h) + self.conv_ax2h(ax)
+                tmp = self.graphed(self.conv_h2h, self.prev_h) + self.conv_ax2h(ax)
             else:
-                tmp = self.conv_ax2h(ax)
-
-            cc_i, cc_f, cc_o, cc_g = torch.split(tmp, self.hidden_dim, dim=1)
-            i = self.sigmoid(cc_i)
-            f = self.sigmoid(cc_f)
-            o = self.sigmoid(cc_o)
-            g = self.tanh(cc_g)
-            if self.prev_c is None:
-                c = i * g
-            else:
-                c = f * self.prev_c + i * g
-            h = o * self.tanh(c)
+                tmp = self.add_bias(self.conv_h2h, self.conv_ax2h(ax))
+
+            h, c = self.lstm_update(tmp, self.prev_c)
             if not inference:
-                result.append(h.unsqueeze(0))
+                result[t] = h
             self.prev_h = h
             self.prev_c = c
         if inference:
-            res = h
-        else:
-            res = torch.cat(result, dim=0)
-        return res
+            return h
+        return result
 
     def reset(self, mask=None):
         """To be called in between batches"""
         if mask is None or self.prev_h is None:
             self.prev_h, self.prev_c = None, None
         else:
-            self.prev_h, self.prev_c = self.prev_h.detach(), self.prev_c.detach()
+            if self.prev_h.requires_grad:
+                self.prev_h, self.prev_c = self.prev_h.detach(), self.prev_c.detach()
             mask = mask.to(self.prev_h)
             self.prev_h *= mask
             self.prev_c *= mask
@@ -437,53 +680,43 @@ class ConvGRUCell(RNNCell):
     def forward(self, xi):
         self.saturation_cost = 0
 
-        xiseq = xi.split(1, 0) #t,n,c,h,w
-
-
-        if self.prev_h is not None:
+        if self.prev_h is not None and self.prev_h.requires_grad:
             self.prev_h = self.prev_h.detach()
-        else:
-            shape = list(xiseq[0].shape)
-            shape[1] = self.hidden_dim
-            self.prev_h = torch.zeros(shape, dtype=torch.float32, device=x.device)
-            self.prev_c = torch.zeros(shape, dtype=torch.float32, device=x.device)
 
-        result = []
-        for t, xt in enumerate(xiseq):
-            xt = xt.squeeze(0)
+        T, N, _, H, W = xi.shape
+        result = xi.new_empty((T, N, self.hidden_dim, H, W))
+        for t in range(T):
+            xt = xi[t]
 
 
             #split x & h in 3
             x_zr, x_h = xt[:, :2*self.hidden_dim], xt[:,2*self.hidden_dim:]
 
             if self.prev_h is not None:
-                tmp = self.conv_h2zr(self.prev_h) + x_zr
+                tmp = self.graphed(self.conv_h2zr, self.prev_h) + x_zr
             else:
-                tmp = x_zr
+                tmp = self.add_bias(self.conv_h2zr, x_zr)
 
-            cc_z, cc_r = torch.split(tmp, self.hidden_dim, dim=1)
-            z = self.sigmoid(cc_z)
-            r = self.sigmoid(cc_r)
+            z, r = self.gru_gates(tmp)
 
             if self.prev_h is not None:
                 tmp = self.conv_h2h(r * self.prev_h) + x_h
             else:
-                tmp = x_h
-            tmp = self.tanh(tmp)
-
-            if self.prev_h is not None:
-                h = (1-z) * self.prev_h + z * tmp
-            else:
-                h = z * tmp
-
+                tmp = self.add_bias(self.conv_h2h, x_h)
+            h = self.gru_update(z, tmp, self.prev_h)
 
-            result.append(h.unsqueeze(0))
+            result[t] = h
             self.prev_h = h
-        res = torch.cat(result, dim=0)
-        return res
+        return result
 
-    def reset(self):
-        self.prev_h = None
+    def reset(self, mask=None):
+        """To be called in between batches"""
+        if mask is None or self.prev_h is None:
+            self.prev_h = None
+        else:
+            if self.prev_h.requires_grad:
+                self.prev_h = self.prev_h.detach()
+            self.prev_h *= mask.to(self.prev_h)
 
 class ConvnBRCCell(RNNCell):
     r"""ConvnBRCCell module, applies sequential part of nBRC cell.
@@ -493,7 +726,7 @@ long-lasting memory
         https://arxiv.org/pdf/2006.05252.pdf
     """
     def __init__(self, hidden_dim, kernel_size, bias, conv_func=nn.Conv2d, hard=False):
-        super(ConvnBRBCell, self).__init__(hard)
+        super(ConvnBRCCell, self).__init__(hard)
         self.hidden_dim = hidden_dim
 
         # Fully-Gated
@@ -514,52 +747,42 @@ long-lasting memory
     def forward(self, xi):
         self.saturation_cost = 0
 
-        xiseq = xi.split(1, 0) #t,n,c,h,w
-
-
-        if self.prev_h is not None:
+        if self.prev_h is not None and self.prev_h.requires_grad:
             self.prev_h = self.prev_h.detach()
-        else:
-            shape = list(xiseq[0].shape)
-            shape[1] = self.hidden_dim
-            self.prev_h = torch.zeros(shape, dtype=torch.float32, device=x.device)
-            self.prev_c = torch.zeros(shape, dtype=torch.float32, device=x.device)
 
-        result = []
-        for t, xt in enumerate(xiseq):
-            xt = xt.squeeze(0)
+        T, N, _, H, W = xi.shape
+        result = xi.new_empty((T, N, self.hidden_dim, H, W))
+        for t in range(T):
+            xt = xi[t]
 
             #split x & h in 3
             x_zr, x_h = xt[:, :2*self.hidden_dim], xt[:,2*self.hidden_dim:]
 
             if self.prev_h is not None:
-                tmp = self.conv_h2zr(self.prev_h) + x_zr
+                tmp = self.graphed(self.conv_h2zr, self.prev_h) + x_zr
             else:
-                tmp = x_zr
+                tmp = self.add_bias(self.conv_h2zr, x_zr)
 
-            cc_z, cc_r = torch.split(tmp, self.hidden_dim, dim=1)
-            z = self.sigmoid(cc_z)
-            r = self.tanh(cc_r)+1 #now R is in [0,2]
+            z, r = self.gru_gates(tmp, bistable=True) #now R is in [0,2]
 
             if self.prev_h is not None:
                 tmp = self.conv_h2h(r * self.prev_h) + x_h
             else:
-                tmp = x_h
-            tmp = self.tanh(tmp)
+                tmp = self.add_bias(self.conv_h2h, x_h)
+            h = self.gru_update(z, tmp, self.prev_h)
 
-            if self.prev_h is not None:
-                h = (1-z) * self.prev_h + z * tmp
-            else:
-                h = z * tmp
-
-
-            result.append(h.unsqueeze(0))
+            result[t] = h
             self.prev_h = h
-        res = torch.cat(result, dim=0)
-        return res
+        return result
 
-    def reset(self):
-        self.prev_h = None
+    def reset(self, mask=None):
+        """To be called in between batches"""
+        if mask is None or self.prev_h is None:
+            self.prev_h = None
+        else:
+            if self.prev_h.requires_grad:
+                self.prev_h = self.prev_h.detach()
+            self.prev_h *= mask.to(self.prev_h)
 
 
 class ConvRNN(nn.Module):
@@ -581,7 +804,7 @@ class ConvRNN(nn.Module):
             self.timepool = ConvGRUCell(out_channels, 3, True, hard=hard, **cell_kwargs)
             factor = 3
         elif cell == 'nbrb':
-            self.timepool = ConvnBRBCell(out_channels, 3, True, hard=hard, **cell_kwargs)
+            self.timepool = ConvnBRCCell(out_channels, 3, True, hard=hard, **cell_kwargs)
             factor = 3
         elif cell == 'alstm':
             self.timepool = ConvALSTMCell(in_channels, out_channels, 3, hard=hard, **cell_kwargs)
@@ -598,6 +821,8 @@ class ConvRNN(nn.Module):
                                                  padding=padding,
                                                  activation='Identity'))
 
+        self.use_cuda_graph = False
+        self._graphs = {}
 
     def forward(self, x):
         #TODO: remove highway after
@@ -605,9 +830,49 @@ class ConvRNN(nn.Module):
             h = self.timepool(x)
         else:
             y = self.conv_x2h(x)
-            h = self.timepool(y)
+            if self.can_graph_timepool(y):
+                h = self.graphed_timepool(y)
+            else:
+                h = self.timepool(y)
         return h
 
+    def can_graph_timepool(self, y):
+        cell = self.timepool
+        return (self.use_cuda_graph and y.is_cuda and not torch.is_grad_enabled()
+                and isinstance(cell, ConvLSTMCell) and not cell.use_cuda_graph and not cell.hard
+                and cell.prev_h is not None)
+
+    def graphed_timepool(self, y):
+        """Replays the whole T-steps LSTM loop from one cuda graph (no-grad, steady state only).
+        One graph per input shape, the state is copied in & out of its static buffers"""
+        cell = self.timepool
+        key = (tuple(y.shape), y.dtype, y.device)
+        entry = self._graphs.get(key)
+        prev_h, prev_c = cell.prev_h, cell.prev_c
+        if entry is None:
+            static_y, static_h, static_c = y.clone(), prev_h.clone(), prev_c.clone()
+            current = torch.cuda.current_stream()
+            stream = torch.cuda.Stream()
+            stream.wait_stream(current)
+            with torch.cuda.stream(stream):
+                for _ in range(3):
+                    cell.prev_h, cell.prev_c = static_h, static_c
+                    cell(static_y)
+            current.wait_stream(stream)
+            graph = torch.cuda.CUDAGraph()
+            cell.prev_h, cell.prev_c = static_h, static_c
+            with torch.cuda.graph(graph):
+                static_out = cell(static_y)
+            entry = (graph, static_y, static_h, static_c, static_out, cell.prev_h, cell.prev_c)
+            self._graphs[key] = entry
+        graph, static_y, static_h, static_c, static_out, out_h, out_c = entry
+        static_y.copy_(y)
+        static_h.copy_(prev_h)
+        static_c.copy_(prev_c)
+        graph.replay()
+        cell.prev_h, cell.prev_c = out_h.clone(), out_c.clone()
+        return static_out.clone()
+
     def reset(self, mask):
         self.timepool.reset(mask)
 
@@ -628,41 +893,29 @@ class BottleneckLSTM(RNNCell):
     def forward(self, xi):
         self.saturation_cost = 0
         xi = self.bottleneck_x2h(xi)
-        inference = (len(xi.shape) == 4)  # inference for model conversion
-        xiseq = xi.split(1, 0)  # t,n,c,h,w
 
-        if self.prev_h is not None:
+        if self.prev_h is not None and self.prev_h.requires_grad:
             self.prev_h = self.prev_h.detach()
             self.prev_c = self.prev_c.detach()
 
-        result = []
-        for t, xt in enumerate(xiseq):
-            if not inference:  # for training/val (not inference)
-                xt = xt.squeeze(0)
+        T, N, _, H, W = xi.shape
+        result = xi.new_empty((T, N, 2 * self.hidden_dim, H, W))
+        for t in range(T):
+            xt = xi[t]
 
             bottleneck = xt if self.prev_h is None else xt + self.bottleneck_h2h(self.prev_h)
             bottleneck = torch.tanh(bottleneck)
 
             gates = self.gates(bottleneck)
 
-            cc_i, cc_f, cc_o, cc_g = torch.split(gates, self.hidden_dim, dim=1)
-            i = self.sigmoid(cc_i)
-            f = self.sigmoid(cc_f)
-            o = self.sigmoid(cc_o)
-            g = self.tanh(cc_g)
-            if self.prev_c is None:
-                c = i * g
-            else:
-                c = f * self.prev_c + i * g
-            h = o * self.tanh(c)
+            h, c = self.lstm_update(gates, self.prev_c)
 
-            output = torch.cat([h, bottleneck], dim=1)
-            result.append(output.unsqueeze(0))
+            result[t, :, :self.hidden_dim] = h
+            result[t, :, self.hidden_dim:] = bottleneck
             self.prev_h = h
             self.prev_c = c
 
-        res = torch.cat(result, dim=0)
-        return res
+        return result
 
     def reset(self):
         self.prev_h, self.prev_c = None, None
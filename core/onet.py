@@ -11,19 +11,27 @@ from core.recurrent import *
 from core.unet import UNet
 
 
+@torch.jit.script
+def gated_update(tmp, prev_h, hidden_dim: int):
+    i, g = torch.split(tmp, hidden_dim, dim=1)
+    return prev_h + torch.sigmoid(i) * torch.tanh(g)
+
+
 class ONet(UNet):
-    def __init__(self, channel_list, mode='cat'):
+    def __init__(self, channel_list, mode='cat', channels_last=False, compile=False):
         down, up = partial(ConvLSTMCell, stride=2), partial(ConvLSTMCell, stride=1)
         skip = partial(nn.Conv2d, kernel_size=3, stride=1, padding=1)
         resize = lambda x,y: F.interpolate(x, size=y.shape[-2:], mode='nearest')
-        super(ONet, self).__init__(channel_list, mode, down, up, skip, resize)
+        super(ONet, self).__init__(channel_list, mode, down, up, skip, resize, compile=compile)
         self.feedback = ConvLayer(self.ups[-1].out_channels, 2 * self.downs[0].out_channels, stride=2)
+        if channels_last:
+            self.to_channels_last()
 
     def forward(self, x):
+        # only the unet pass is compiled, the feedback state update stays eager
         res = super().forward(x)
         tmp = self.feedback(self.ups[-1].prev_h)
-        i, g = torch.split(tmp, self.downs[0].out_channels, dim=1)
-        self.downs[0].prev_h = self.downs[0].prev_h + (torch.sigmoid(i) * torch.tanh(g))
+        self.downs[0].prev_h = gated_update(tmp, self.downs[0].prev_h, self.downs[0].out_channels)
         return res
 
 
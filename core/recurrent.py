@@ -7,7 +7,7 @@ import torch.nn as nn
 from torch.nn import functional as F
 import torch
 from core.utils.opts import time_to_batch, batch_to_time
-from core.modules import ConvLayer
+from core.modules import ConvLayer, _lstm_pointwise, _lstm_pointwise_inplace, _hard_sigmoid, _hard_tanh
 
 
 
@@ -26,8 +26,7 @@ class RNNWise(nn.Sequential):
 
     def pack_results(self, outs):
         if isinstance(outs[0], torch.Tensor):
-            outs = [item.unsqueeze(0) for item in outs]
-            outs = torch.cat(outs, dim=0)
+            outs = torch.stack(outs, dim=0)
         elif isinstance(outs[0], list):
             t, n = len(outs), len(outs[0])
             res = [[outs[j][i] for j in range(t)] for i in range(n)]
@@ -36,10 +35,9 @@ class RNNWise(nn.Sequential):
 
     def forward(self, x):
         self.detach_modules()
-        xiseq = x.split(1, 0)
         res = []
-        for t, xt in enumerate(xiseq):
-            y = super().forward(xt[0])
+        for t in range(len(x)):
+            y = super().forward(x[t])
             res.append(y)
 
         return self.pack_results(res)
@@ -70,6 +68,7 @@ class RNNCell(nn.Module):
         self.set_gates(hard)
 
     def set_gates(self, hard):
+        self.hard = hard
         if hard:
             self.sigmoid = self.hard_sigmoid
             self.tanh = self.hard_tanh
@@ -77,16 +76,19 @@ class RNNCell(nn.Module):
             self.sigmoid = torch.sigmoid
             self.tanh = torch.tanh
 
+    def track_saturation(self):
+        """the saturation cost is a training regularizer only"""
+        return self.training and self.saturation_weight > 0
+
     def hard_sigmoid(self, x_in):
-        self.add_saturation_cost(x_in)
-        x = x_in * 0.5 + 0.5
-        y = torch.clamp(x, 0.0, 1.0)
-        return y
+        if self.track_saturation():
+            self.add_saturation_cost(x_in)
+        return _hard_sigmoid(x_in)
 
     def hard_tanh(self, x):
-        self.add_saturation_cost(x)
-        y = torch.clamp(x, -1.0, 1.0)
-        return y
+        if self.track_saturation():
+            self.add_saturation_cost(x)
+        return _hard_tanh(x)
 
     def add_saturation_cost(self, var):
         """Calculate saturation cost."""
@@ -152,13 +154,19 @@ class ConvLSTMCell(RNNCell):
         if self.prev_fb is not None:
             tmp += self.conv_fb2h(self.prev_fb)
 
-        cc_i, cc_f, cc_o, cc_g = torch.split(tmp, self.out_channels, dim=1)
-        i = self.sigmoid(cc_i)
-        f = self.sigmoid(cc_f)
-        o = self.sigmoid(cc_o)
-        g = self.tanh(cc_g)
-        c = f * self.prev_c + i * g
-        h = o * self.tanh(c)
+        if not (self.hard and self.track_saturation()):
+            if not torch.is_grad_enabled() and tmp.device.type == 'cpu':
+                h, c = _lstm_pointwise_inplace(tmp, self.prev_c, self.out_channels, self.hard)
+            else:
+                h, c = _lstm_pointwise(tmp, self.prev_c, self.out_channels, self.hard)
+        else:
+            cc_i, cc_f, cc_o, cc_g = torch.split(tmp, self.out_channels, dim=1)
+            i = self.sigmoid(cc_i)
+            f = self.sigmoid(cc_f)
+            o = self.sigmoid(cc_o)
+            g = self.tanh(cc_g)
+            c = f * self.prev_c + i * g
+            h = o * self.tanh(c)
         self.prev_c = c
         self.prev_h = h
 
@@ -166,10 +174,10 @@ class ConvLSTMCell(RNNCell):
 
     def detach(self):
         self.saturation_cost = 0
-        if self.prev_h is not None:
+        if self.prev_h is not None and self.prev_h.requires_grad:
             self.prev_h = self.prev_h.detach()
             self.prev_c = self.prev_c.detach()
-        if self.prev_fb is not None:
+        if self.prev_fb is not None and self.prev_fb.requires_grad:
             self.prev_fb = self.prev_fb.detach()
 
     def reset(self, mask=None):
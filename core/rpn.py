@@ -104,6 +104,29 @@ class BoxHead(nn.Module):
         cls_preds = self._apply_head(self.cls_head, xs, self.num_classes)
         return loc_preds, cls_preds  
 
+    def quantize(self, calibration, backend='fbgemm'):
+        """Post-training static int8 quantization of the heads (fx graph mode, cpu)
+        depthwise convs do not quantize well and stay in float.
+
+        :param calibration: list of features lists (as passed to forward)
+        """
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+        torch.backends.quantized.engine = backend
+        for attr in ('box_head', 'cls_head'):
+            head = getattr(self, attr).eval()
+            qconfig_mapping = get_default_qconfig_mapping(backend)
+            for name, module in head.named_modules():
+                if isinstance(module, nn.Conv2d) and module.groups > 1 and module.groups == module.in_channels:
+                    qconfig_mapping.set_module_name(name, None)
+            prepared = prepare_fx(head, qconfig_mapping, (calibration[0][0],))
+            with torch.no_grad():
+                for xs in calibration:
+                    for x in xs:
+                        prepared(x)
+            setattr(self, attr, convert_fx(prepared))
+        return self
+
     def probas(self, cls_preds):
         if not self.training:
             if self.act == 'softmax':
@@ -8,7 +8,8 @@ import torch.nn as nn
 
 from core.losses import DetectionLoss, attention_loss
 from core.backbones import Vanilla, FPN, FBN, MobileNetFPN, ResNet50FPN, ResNet50SSD
-from core.modules import ConvRNN, ConvALSTMCell
+from core.modules import ConvRNN, ConvALSTMCell, ConvLayer, SequenceWise
+from core.utils.opts import time_to_batch
 from core.anchors import Anchors
 from core.rpn import BoxHead, SSDHead
 from core.utils.box import box_drawing
@@ -76,6 +77,38 @@ class SingleStageDetector(nn.Module):
         return loss_dict
 
 
+    def fuse_bn(self):
+        """Folds the BatchNorms into their convs where exact (inference only, not reversible)"""
+        assert not self.training, "call eval() before fusing batchnorms"
+        for module in self.modules():
+            if isinstance(module, ConvLayer):
+                module.fuse_bn()
+        return self
+
+    @torch.no_grad()
+    def optimize_for_inference(self, x):
+        """Freezes the feedforward stem (convs, bn, residual blocks) with torchscript,
+        the frozen graph passes then fold the batchnorms & fuse conv-add-relu.
+        The recurrent part keeps python state and stays eager.
+        The stem is traced for the spatial size of x: [T,N,C,H,W] (inference only, not reversible)"""
+        assert not self.training, "call eval() before optimizing for inference"
+        stem = getattr(self.feature_extractor, 'conv1', None)
+        if isinstance(stem, SequenceWise) and not isinstance(stem.module, torch.jit.ScriptModule):
+            example = time_to_batch(x)[0]
+            traced = torch.jit.trace(stem.module, example)
+            stem.module = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+        return self
+
+    @torch.no_grad()
+    def quantize(self, batches, backend='fbgemm'):
+        """int8 BoxHead (cpu), calibrated on the features of a few input batches [T,N,C,H,W]"""
+        assert not self.training, "call eval() before quantizing"
+        assert isinstance(self.rpn, BoxHead)
+        calibration = [self.feature_extractor(x) for x in batches]
+        self.rpn.quantize(calibration, backend)
+        return self
+
+    @torch.no_grad()
     def get_boxes(self, x, score_thresh=0.4):
         xs = self.feature_extractor(x)
         loc_preds, cls_preds = self.rpn(xs)
@@ -5,7 +5,9 @@ from __future__ import print_function
 import math
 import torch
 from core.utils.box import box_soft_nms, box_nms, np_box_nms, change_box_order, assign_priors, box_iou
+from core.utils.box import assign_priors_batched, pack_boxes_list, box_fast_nms, box_soft_nms_from_iou
 from core.utils import opts
+from torchvision.ops.boxes import batched_nms
 
 
 
@@ -49,8 +51,15 @@ def get_box_params_fixed_size(sources, h, w):
     return fm_sizes, steps, box_sizes
 
 
+def _decode_loc(loc_preds, default_boxes, var0, var1):
+    xy = loc_preds[..., :2] * var0 * default_boxes[..., 2:] + default_boxes[..., :2]
+    wh = torch.exp(loc_preds[..., 2:] * var1) * default_boxes[..., 2:]
+    return torch.cat([xy - wh / 2, xy + wh / 2], -1)
+
+
 class SSDBoxCoder(torch.nn.Module):
-    def __init__(self, ssd_model, fg_iou_threshold=0.6, bg_iou_threshold=0.4, soft_nms=False):
+    def __init__(self, ssd_model, fg_iou_threshold=0.6, bg_iou_threshold=0.4, soft_nms=False, nms_type=None,
+                 compile_decode=False):
         super(SSDBoxCoder, self).__init__()
 
         self.steps = ssd_model.steps
@@ -61,14 +70,18 @@ class SSDBoxCoder(torch.nn.Module):
         self.height = ssd_model.height
         self.width = ssd_model.width
         self.fm_len = []
+        self.variances = (0.1, 0.2)
         self.register_buffer('default_boxes', self._get_default_boxes_v2())
         self.register_buffer('default_boxes_xyxy', change_box_order(self.default_boxes, 'xywh2xyxy'))
+        self._set_inverse_wh()
         self.fg_iou_threshold = fg_iou_threshold
         self.bg_iou_threshold = bg_iou_threshold
         self.use_cuda = False
-        self.variances = (0.1, 0.2)
+        self.nms_type = nms_type or ('soft_nms' if soft_nms else 'nms')
         self.nms = box_soft_nms if soft_nms else box_nms
         self.encode = self.encode_fast
+        self.compile_decode = compile_decode and hasattr(torch, 'compile')
+        self._compiled_decode = None
 
     def reset(self, ssd_model):
         self.steps = ssd_model.steps
@@ -80,6 +93,7 @@ class SSDBoxCoder(torch.nn.Module):
         self.fm_len = []
         self.register_buffer('default_boxes', self._get_default_boxes())
         self.register_buffer('default_boxes_xyxy', change_box_order(self.default_boxes, 'xywh2xyxy'))
+        self._set_inverse_wh()
 
     def __greet__(self):
         print('steps', self.steps)
@@ -98,6 +112,13 @@ class SSDBoxCoder(torch.nn.Module):
         self.width = ssd_model.width
         self.default_boxes = self._get_default_boxes()
         self.default_boxes_xyxy =  change_box_order(self.default_boxes, 'xywh2xyxy')
+        self._set_inverse_wh()
+
+    def _set_inverse_wh(self):
+        # the priors are constant, so the divisions of the encoding are precomputed once
+        inv_wh = 1.0 / self.default_boxes[:, 2:]
+        self.register_buffer('inv_default_wh', inv_wh)
+        self.register_buffer('inv_default_wh_var0', inv_wh / self.variances[0])
 
     def _get_default_boxes_v2(self):
         boxes = []
@@ -156,7 +177,7 @@ class SSDBoxCoder(torch.nn.Module):
         labels = gt_labels + 1
         default_boxes = self.default_boxes_xyxy
         ious = box_iou(default_boxes, boxes)  # [#anchors, #obj]
-        index = torch.zeros(len(default_boxes), dtype=torch.int64, device=boxes.device).fill_(-1)
+        index = torch.full((len(default_boxes),), -1, dtype=torch.int64, device=boxes.device)
 
         # We match every ground truth with higher than iou_threshold iou with an anchor
         max_iou_anchors, arg_max_iou_anchors = torch.max(ious, dim=1)
@@ -187,13 +208,14 @@ class SSDBoxCoder(torch.nn.Module):
     def encode_fast(self, gt_boxes, labels):
         boxes, cls_targets = assign_priors(gt_boxes, labels + 1, self.default_boxes_xyxy,
                                             self.fg_iou_threshold, self.bg_iou_threshold)
+        return self._encode_loc(boxes), cls_targets
 
+    def _encode_loc(self, boxes):
+        # boxes: (..., #anchors, 4) in xyxy, matched to the default boxes
         boxes = change_box_order(boxes, 'xyxy2xywh')
-        default_boxes = self.default_boxes
-        loc_xy = (boxes[:, :2] - default_boxes[:, :2]) / default_boxes[:, 2:] / self.variances[0]
-        loc_wh = torch.log(boxes[:, 2:] / default_boxes[:, 2:]) / self.variances[1]
-        loc_targets = torch.cat([loc_xy, loc_wh], 1)
-        return loc_targets, cls_targets
+        loc_xy = (boxes[..., :2] - self.default_boxes[:, :2]) * self.inv_default_wh_var0
+        loc_wh = torch.log(boxes[..., 2:] * self.inv_default_wh).mul_(1.0 / self.variances[1])
+        return torch.cat([loc_xy, loc_wh], -1)
 
     def decode_loc(self, loc_preds):
         if loc_preds.dim() > self.default_boxes.dim():
@@ -201,85 +223,78 @@ class SSDBoxCoder(torch.nn.Module):
         else:
             default_boxes = self.default_boxes
 
-        xy = loc_preds[..., :2] * self.variances[0] * default_boxes[..., 2:] + default_boxes[..., :2]
-        wh = torch.exp(loc_preds[..., 2:] * self.variances[1]) * default_boxes[..., 2:]
-        box_preds = torch.cat([xy - wh / 2, xy + wh / 2], -1)
-        return box_preds
+        decode = _decode_loc
+        if self.compile_decode:
+            # compiled lazily, on first decode (inference shapes are fixed)
+            if self._compiled_decode is None:
+                self._compiled_decode = torch.compile(_decode_loc, dynamic=False)
+            decode = self._compiled_decode
+        return decode(loc_preds, default_boxes, self.variances[0], self.variances[1])
 
     def multiclass_nms(self, box_preds, cls_preds, score_thresh=0.5, nms_thresh=0.45):
-        boxes = []
-        labels = []
-        scores = []
-        num_classes = cls_preds.shape[1]
-
-        for i in range(num_classes-1):
-            score = cls_preds[:,i+1]  # class i corresponds to (i+1) column
-            mask = score > score_thresh
-            if not mask.any():
-                continue
-
-            box = box_preds[mask]
-            score = score[mask]
-
-            keep = self.nms(box, score, nms_thresh)
-            boxes.append(box[keep])
-            labels.append(torch.LongTensor(len(box[keep])).fill_(i))
-            scores.append(score[keep])
+        if self.nms_type == 'nms':
+            return self.batched_multiclass_nms(box_preds, cls_preds, score_thresh, nms_thresh)
+        elif self.nms_type == 'fast_nms':
+            boxes, labels, scores = box_fast_nms(box_preds, cls_preds[:, 1:], nms_thresh, score_thresh)
+            if len(boxes) == 0:
+                return None, None, None
+            return boxes, labels, scores
+        elif self.nms_type != 'soft_nms':
+            raise ValueError('Unknown nms_type: %s.' % self.nms_type)
 
+        # threshold all classes at once, then soft-nms from a shared overlap template
+        scores = cls_preds[:, 1:]  # class i corresponds to (i+1) column
+        anchor_idx, labels = (scores > score_thresh).nonzero(as_tuple=True)
+        if len(anchor_idx) == 0:
+            return None, None, None
 
-        if len(boxes) > 0:
-            boxes = torch.cat(boxes, 0)
-            labels = torch.cat(labels, 0)
-            scores = torch.cat(scores, 0)
-            return boxes, labels, scores
-        else:
+        boxes = box_preds[anchor_idx]
+        scores = scores[anchor_idx, labels]
+        # boxes are shared by all classes: overlap template once per surviving anchor,
+        # (same +1 convention as box_soft_nms) then soft-nms on each class block of it
+        anchors, inverse = anchor_idx.unique(return_inverse=True)
+        anchor_ious = box_iou(box_preds[anchors], box_preds[anchors], offset=1)
+        keep = []
+        for label in labels.unique():
+            idx_c = (labels == label).nonzero(as_tuple=True)[0]
+            inv_c = inverse[idx_c]
+            keep_c = box_soft_nms_from_iou(anchor_ious[inv_c][:, inv_c], scores[idx_c], nms_thresh)
+            keep.append(idx_c[keep_c])
+        keep = torch.cat(keep)
+        return boxes[keep], labels[keep], scores[keep]
+
+    def batched_multiclass_nms(self, box_preds, cls_preds, score_thresh=0.5, nms_thresh=0.45):
+        # threshold all classes at once, then one nms where classes are offset so they never overlap
+        scores = cls_preds[:, 1:]  # class i corresponds to (i+1) column
+        anchor_idx, labels = (scores > score_thresh).nonzero(as_tuple=True)
+        if len(anchor_idx) == 0:
             return None, None, None
 
-    def encode_boxes(self, targets):
-        loc_targets, cls_targets = [], []
+        boxes = box_preds[anchor_idx]
+        scores = scores[anchor_idx, labels]
+        keep = batched_nms(boxes, scores, labels, nms_thresh)
+        return boxes[keep], labels[keep], scores[keep]
 
-        device = self.default_boxes.device
+    def _encode_frames(self, frames):
+        # all frames are encoded at once by padding the gt with dummies (label -2)
+        frames = [frame if len(frame) else torch.ones((1, 5), dtype=torch.float32)*-1 for frame in frames]
+        gt_padded, _ = pack_boxes_list(frames)
 
-        for t in range(len(targets)):
-            if len(targets[t]) == 0:
-                targets[t] = torch.ones((1, 5), dtype=torch.float32)*-1
+        gt_padded = gt_padded.to(self.default_boxes.device)
+        gt_boxes, gt_labels = gt_padded[..., :4], gt_padded[..., -1]
+        gt_mask = gt_labels != -2
 
-            boxes, labels = targets[t][:, :4], targets[t][:, -1]
-            boxes, labels = boxes.to(device), labels.to(device)
+        boxes, cls_targets = assign_priors_batched(gt_boxes, gt_labels + 1, gt_mask, self.default_boxes_xyxy,
+                                                   self.fg_iou_threshold, self.bg_iou_threshold)
 
-            loc_t, cls_t = self.encode(boxes, labels)
-            loc_targets.append(loc_t.unsqueeze(0))
-            cls_targets.append(cls_t.unsqueeze(0).long())
+        loc_targets = self._encode_loc(boxes)  # (N,#anchors,4)
+        return loc_targets, cls_targets.long()  # (N,#anchors)
 
-        loc_targets = torch.cat(loc_targets, dim=0)  # (N,#anchors,4)
-        cls_targets = torch.cat(cls_targets, dim=0)  # (N,#anchors,C)
-        return loc_targets, cls_targets
+    def encode_boxes(self, targets):
+        return self._encode_frames(targets)
 
     def encode_txn_boxes(self, targets):
-        # import time
-        # start = time.time()
-        loc_targets, cls_targets = [], []
-
-        device = self.default_boxes.device
-
-        for t in range(len(targets)):
-            for i in range(len(targets[t])):
-                if len(targets[t][i]) == 0:
-                    targets[t][i] = torch.ones((1, 5), dtype=torch.float32)*-1
-
-                boxes, labels = targets[t][i][:, :4], targets[t][i][:, -1]
-                boxes, labels = boxes.to(device), labels.to(device)
-
-                loc_t, cls_t = self.encode(boxes, labels)
-                loc_targets.append(loc_t.unsqueeze(0))
-                cls_targets.append(cls_t.unsqueeze(0).long())
-
-        loc_targets = torch.cat(loc_targets, dim=0)  # (N,#anchors,4)
-        cls_targets = torch.cat(cls_targets, dim=0)  # (N,#anchors,C)
-
-        # print((time.time()-start), ' s for encoding')
-
-        return loc_targets, cls_targets
+        return self._encode_frames([frame for time in targets for frame in time])
 
     def decode_txn_boxes(self, loc_preds, cls_preds, batchsize, score_thresh):
         box_preds = self.decode_loc(loc_preds)
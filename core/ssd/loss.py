@@ -5,7 +5,7 @@ from __future__ import print_function
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from core.utils.box import box_iou
+from core.utils.box import paired_box_iou
 from core.utils.opts import time_to_batch, batch_to_time
 
 
@@ -17,12 +17,55 @@ def reduce(loss, mode='none'):
     return loss
 
 
+@torch.jit.script
+def _softmax_focal_term(x, y, alpha, gamma: float):
+    ce = F.cross_entropy(x, y, reduction='none')  # -log(pt)
+    pt = torch.exp(-ce)
+    return alpha.index_select(0, y) * (1 - pt).pow(gamma) * ce
+
+
+@torch.jit.script
+def _sigmoid_focal_term(x, y, alpha: float, gamma: float):
+    # every logit as a negative, -log(1-p) = softplus(x)
+    neg = (1 - alpha) * torch.sigmoid(x).pow(gamma) * F.softplus(x)
+    neg = neg.scatter_(1, y[:, None], 0.)
+    # target logit as a positive, -log(p) = softplus(-x)
+    x_t = x.gather(1, y[:, None]).squeeze(1)
+    pos = alpha * (1 - torch.sigmoid(x_t)).pow(gamma) * F.softplus(-x_t)
+    return neg.sum(dim=-1) + pos
+
+
+@torch.jit.script
+def _bounded_iou_term(pred, target, beta: float, eps: float):
+    pred_ctrx = (pred[:, 0] + pred[:, 2]) * 0.5
+    pred_ctry = (pred[:, 1] + pred[:, 3]) * 0.5
+    pred_w = pred[:, 2] - pred[:, 0] + 1
+    pred_h = pred[:, 3] - pred[:, 1] + 1
+    target = target.detach()
+    target_ctrx = (target[:, 0] + target[:, 2]) * 0.5
+    target_ctry = (target[:, 1] + target[:, 3]) * 0.5
+    target_w = target[:, 2] - target[:, 0] + 1
+    target_h = target[:, 3] - target[:, 1] + 1
+
+    dx = target_ctrx - pred_ctrx
+    dy = target_ctry - pred_ctry
+
+    loss_dx = 1 - torch.clamp((target_w - 2 * dx.abs()) / (target_w + 2 * dx.abs() + eps), min=0.)
+    loss_dy = 1 - torch.clamp((target_h - 2 * dy.abs()) / (target_h + 2 * dy.abs() + eps), min=0.)
+    loss_dw = 1 - torch.min(target_w / (pred_w + eps), pred_w / (target_w + eps))
+    loss_dh = 1 - torch.min(target_h / (pred_h + eps), pred_h / (target_h + eps))
+    loss_comb = torch.stack([loss_dx, loss_dy, loss_dw, loss_dh], dim=-1)
+
+    return torch.where(loss_comb < beta, 0.5 * loss_comb * loss_comb / beta,
+                       loss_comb - 0.5 * beta)
+
+
 class SSDLoss(nn.Module):
     def __init__(self, num_classes, mode='focal', use_sigmoid=False, use_iou=False):
         super(SSDLoss, self).__init__()
         self.num_classes = num_classes
         self.mode = mode
-        self.alpha = torch.nn.Parameter(torch.ones(num_classes))
+        self.register_buffer('alpha', torch.ones(num_classes))  # per-class weights
         self.focal_loss = self._sigmoid_focal_loss if use_sigmoid else self._softmax_focal_loss
         self.use_iou = use_iou
 
@@ -38,10 +81,13 @@ class SSDLoss(nn.Module):
         '''
         cls_loss = cls_loss * (pos.float() - 1)
 
-        _, idx = cls_loss.sort(1)  # sort by negative losses
-        _, rank = idx.sort(1)      # [N,#anchors]
-
         num_neg = 3*pos.sum(1)  # [N,]
+        k = min(int(num_neg.max().item()), cls_loss.size(1))
+        _, idx = (-cls_loss).topk(k, dim=1)  # k largest negative losses
+
+        # rank of the k hardest anchors, k for all others
+        rank = torch.full(cls_loss.shape, k, dtype=torch.long, device=cls_loss.device)
+        rank.scatter_(1, idx, torch.arange(k, device=idx.device).expand_as(idx))
         neg = rank < num_neg[:,None]   # [N,#anchors]
         return neg
 
@@ -56,12 +102,7 @@ class SSDLoss(nn.Module):
           (tensor) focal loss.
         '''
         gamma = 2.0
-        r = torch.arange(x.size(0))
-        ce = F.log_softmax(x, dim=1)[r, y]
-        pt = torch.exp(ce)
-        weights = (1-pt).pow(gamma)
-        loss = -(weights * ce)
-
+        loss = _softmax_focal_term(x, y, self.alpha, gamma)
         return reduce(loss, reduction)
 
     def _sigmoid_focal_loss(self, pred, target, reduction='none'):
@@ -76,15 +117,7 @@ class SSDLoss(nn.Module):
         '''
         alpha = 0.25
         gamma = 2.0
-        pred_sigmoid = pred.sigmoid()
-        target = torch.eye(self.num_classes, device=pred.device, dtype=pred.dtype)[target]
-
-        pt = (1 - pred_sigmoid) * target + pred_sigmoid * (1 - target)
-        focal_weight = (alpha * target + (1 - alpha) *
-                        (1 - target)) * pt.pow(gamma)
-        loss = F.binary_cross_entropy_with_logits(
-            pred, target, reduction='none') * focal_weight
-        loss = loss.sum(dim=-1)
+        loss = _sigmoid_focal_term(pred, target, alpha, gamma)
         loss = reduce(loss, reduction)
         return loss
 
@@ -101,11 +134,11 @@ class SSDLoss(nn.Module):
           (tensor) loss = SmoothL1Loss(loc_preds, loc_targets) + CrossEntropyLoss(cls_preds, cls_targets).
         '''
         mask_ign = cls_targets < 0
-        cls_targets[mask_ign] = 0
+        cls_targets = cls_targets.masked_fill(mask_ign, 0)
 
         pos = cls_targets > 0  # [N,#anchors]
         batch_size = pos.size(0)
-        num_pos = pos.sum().item()
+        num_pos = pos.sum().clamp_min_(1).to(loc_preds.dtype)  # stays on device, no sync
 
         #===============================================================
         # loc_loss
@@ -115,8 +148,9 @@ class SSDLoss(nn.Module):
             loc_loss = self._bounded_iou_loss(loc_preds[pos], loc_targets[pos])
             loc_loss = reduce(loc_loss, mode='sum')
         else:
-            mask = pos.unsqueeze(2).expand_as(loc_preds)  # [N,#anchors,4]
-            loc_loss = F.smooth_l1_loss(loc_preds[mask], loc_targets[mask], reduction='sum')
+            flat_pos = pos.view(-1)  # [N*#anchors,]
+            loc_loss = F.smooth_l1_loss(loc_preds.reshape(-1, 4)[flat_pos], loc_targets.reshape(-1, 4)[flat_pos],
+                                        reduction='sum')
 
 
         #===============================================================
@@ -126,22 +160,21 @@ class SSDLoss(nn.Module):
             cls_loss = F.cross_entropy(cls_preds.view(-1, self.num_classes), \
                                        cls_targets.view(-1), reduction='none')  # [N*#anchors,]
             cls_loss = cls_loss.view(batch_size, -1)
-            cls_loss[mask_ign] = 0  # set ignored loss to 0
+            cls_loss = cls_loss.masked_fill(mask_ign, 0)  # set ignored loss to 0
             if self.mode == 'ohem':
                 neg = self._hard_negative_mining(cls_loss, pos)  # [N,#anchors]
                 cls_loss = cls_loss[pos|neg].sum()
             else:
                 cls_loss = cls_loss.sum()
-            cls_loss /= num_pos
+            cls_loss = cls_loss / num_pos
         else:
             cls_loss = self.focal_loss(cls_preds.view(-1, self.num_classes), cls_targets.view(-1))
             cls_loss = cls_loss.view(batch_size, -1)
-            cls_loss[mask_ign] = 0
+            cls_loss = cls_loss.masked_fill(mask_ign, 0)
             cls_loss = cls_loss.sum()
-            cls_loss /= num_pos
+            cls_loss = cls_loss / num_pos
 
-        #print('loc_loss: %.3f | cls_loss: %.3f' % (loc_loss.item()/num_pos, cls_loss.item()/num_pos), end=' | ')
-        loc_loss /= num_pos
+        loc_loss = loc_loss / num_pos
         return loc_loss, cls_loss
 
     def _asso_loss(self, pred_scores, batchsize):
@@ -156,12 +189,13 @@ class SSDLoss(nn.Module):
         return loss_asso
 
 
-    def _embeddings_loss(self, emb, ids, cls_targets, batchsize):
+    def _embeddings_loss(self, emb, ids, cls_targets, batchsize, chunk_size=1024):
         """
         In Time, promote similarity between targets with same id
 
         :param pred_embeddings: [TN, #anchors, D]
         :param ids: [TN, #nanchors]
+        :param chunk_size: rows of the pairwise matrix computed at once
         :return:
         """
         pos = (cls_targets > 0).view(-1)
@@ -181,17 +215,17 @@ class SSDLoss(nn.Module):
         # We do cos(x1, x2) between every vectors
         # When they have same id = we use loss as 1 - cos (penalize for being far)
         # When they have not same id = max(0, cos - margin) (penalize for not being close)
-        y = (ids[:, None] == ids[None, :])
-        norms = torch.norm(emb, dim=1)
-        norm_matrix = norms[:,None] * norms[None, :]
-        dot_matrix = torch.mm(emb, emb.t())
-        cos_matrix = dot_matrix / norm_matrix
-
+        # normalize once, then go through the [P, P] cosine matrix by blocks of rows
+        emb = F.normalize(emb, dim=1, eps=1e-6)
+        num = len(emb)
         margin = 0.5
-        loss = torch.where(y, 1 - cos_matrix, F.relu(cos_matrix - margin))
-
+        loss = emb.new_zeros(())
+        for i in range(0, num, chunk_size):
+            cos_matrix = torch.mm(emb[i:i+chunk_size], emb.t())
+            y = (ids[i:i+chunk_size, None] == ids[None, :])
+            loss = loss + torch.where(y, 1 - cos_matrix, F.relu(cos_matrix - margin)).sum()
 
-        return loss.mean()
+        return loss / (num * num)
 
 
     def _iou_loss(self, pred, target):
@@ -201,7 +235,7 @@ class SSDLoss(nn.Module):
             pred (tensor): Predicted bboxes.
             target (tensor): Target bboxes.
         """
-        ious = box_iou(pred, target).max(dim=-1)[0]
+        ious = paired_box_iou(pred, target)
         loc_loss = -torch.log(ious)
         return loc_loss
 
@@ -214,32 +248,4 @@ class SSDLoss(nn.Module):
             beta (float): beta parameter in smoothl1.
             eps (float): eps to avoid NaN.
         """
-        pred_ctrx = (pred[:, 0] + pred[:, 2]) * 0.5
-        pred_ctry = (pred[:, 1] + pred[:, 3]) * 0.5
-        pred_w = pred[:, 2] - pred[:, 0] + 1
-        pred_h = pred[:, 3] - pred[:, 1] + 1
-        with torch.no_grad():
-            target_ctrx = (target[:, 0] + target[:, 2]) * 0.5
-            target_ctry = (target[:, 1] + target[:, 3]) * 0.5
-            target_w = target[:, 2] - target[:, 0] + 1
-            target_h = target[:, 3] - target[:, 1] + 1
-
-        dx = target_ctrx - pred_ctrx
-        dy = target_ctry - pred_ctry
-
-        loss_dx = 1 - torch.max(
-            (target_w - 2 * dx.abs()) /
-            (target_w + 2 * dx.abs() + eps), torch.zeros_like(dx))
-        loss_dy = 1 - torch.max(
-            (target_h - 2 * dy.abs()) /
-            (target_h + 2 * dy.abs() + eps), torch.zeros_like(dy))
-        loss_dw = 1 - torch.min(target_w / (pred_w + eps), pred_w /
-                                (target_w + eps))
-        loss_dh = 1 - torch.min(target_h / (pred_h + eps), pred_h /
-                                (target_h + eps))
-        loss_comb = torch.stack([loss_dx, loss_dy, loss_dw, loss_dh],
-                                dim=-1).view(loss_dx.size(0), -1)
-
-        loss = torch.where(loss_comb < beta, 0.5 * loss_comb * loss_comb / beta,
-                           loss_comb - 0.5 * beta)
-        return loss
+        return _bounded_iou_term(pred, target, beta, eps)
@@ -104,9 +104,9 @@ class TwoStageDetector(nn.Module):
                     boxes = boxes.detach()
                     rois_xyxy += [boxes]
                     rois += [box.change_box_order(boxes, 'xyxy2xywh')] 
-                    idxs += [t*stride + i] * num  
+                    idxs += [torch.full((num,), t*stride + i, dtype=torch.long, device=boxes.device)]
 
-        idxs = torch.LongTensor(idxs).to(rois[0].device)
+        idxs = torch.cat(idxs)
         return rois, rois_xyxy, sizes, idxs
 
     def compute_loss(self, x, targets):
@@ -128,6 +128,7 @@ class TwoStageDetector(nn.Module):
 
         return loss_dict
 
+    @torch.no_grad()
     def get_boxes(self, x, score_thresh=0.4):
         batchsize = x.size(1)
         out = self(x)
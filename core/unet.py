@@ -17,7 +17,7 @@ def sequence_upsample(x, y):
     return x
 
 class UNet(nn.Module):
-    def __init__(self, channel_list, mode, down, up, skip, resize):
+    def __init__(self, channel_list, mode, down, up, skip, resize, channels_last=False, compile=False):
         """
         UNET generic: user's choice of layers
 
@@ -28,6 +28,8 @@ class UNet(nn.Module):
         :param up: up function with signature f(x, y), from channels x to y
         :param skip: skip function with signature f(x, y), from channels x to y
         :param resize: resize function with signature f(x, y), resize x like y
+        :param channels_last: nhwc weights & (4d) inputs, for tensor-core friendly cudnn kernels
+        :param compile: run the down/up/skip pass through torch.compile (if available)
         """
         super(UNet, self).__init__()
 
@@ -47,6 +49,17 @@ class UNet(nn.Module):
         else:
             self.skips = [lambda x:x for _ in self.up_list]
 
+        self.channels_last = channels_last
+        if channels_last:
+            self.to_channels_last()
+
+        self.compile_forward = compile and hasattr(torch, 'compile')
+        self._compiled_forward = None
+
+    def to_channels_last(self):
+        self.channels_last = True
+        return self.to(memory_format=torch.channels_last)
+
     @staticmethod
     def print_shapes(activation_list):
         print([item.shape for item in activation_list])
@@ -86,7 +99,15 @@ class UNet(nn.Module):
             return x + y
 
     def forward(self, x):
-        xin = x
+        if self.channels_last and x.dim() == 4:
+            x = x.contiguous(memory_format=torch.channels_last)
+        if self.compile_forward:
+            if self._compiled_forward is None:
+                self._compiled_forward = torch.compile(self.forward_unet)
+            return self._compiled_forward(x)
+        return self.forward_unet(x)
+
+    def forward_unet(self, x):
         outs = [x]
         for down_layer in self.downs:
             x = down_layer(x)
@@ -59,7 +59,7 @@ def box_select(boxes, xmin, ymin, xmax, ymax):
     boxes = boxes[mask,:]
     return boxes, mask
 
-def box_iou(box1, box2):
+def box_iou(box1, box2, offset=0):
     '''Compute the intersection over union of two set of boxes.
 
     The box order must be (xmin, ymin, xmax, ymax).
@@ -67,6 +67,7 @@ def box_iou(box1, box2):
     Args:
       box1: (tensor) bounding boxes, sized [N,4].
       box2: (tensor) bounding boxes, sized [M,4].
+      offset: (int) added to widths and heights (1 for the inclusive pixel convention of box_soft_nms).
 
     Return:
       (tensor) iou, sized [N,M].
@@ -77,15 +78,39 @@ def box_iou(box1, box2):
     lt = torch.max(box1[:,None,:2], box2[:,:2])  # [N,M,2]
     rb = torch.min(box1[:,None,2:], box2[:,2:])  # [N,M,2]
 
-    wh = (rb-lt).clamp(min=0)      # [N,M,2]
+    wh = (rb-lt+offset).clamp(min=0)      # [N,M,2]
     inter = wh[:,:,0] * wh[:,:,1]  # [N,M]
 
-    area1 = (box1[:,2]-box1[:,0]) * (box1[:,3]-box1[:,1])  # [N,]
-    area2 = (box2[:,2]-box2[:,0]) * (box2[:,3]-box2[:,1])  # [M,]
+    area1 = (box1[:,2]-box1[:,0]+offset) * (box1[:,3]-box1[:,1]+offset)  # [N,]
+    area2 = (box2[:,2]-box2[:,0]+offset) * (box2[:,3]-box2[:,1]+offset)  # [M,]
     iou = inter / (area1[:,None] + area2 - inter)
     return iou
 
 
+def paired_box_iou(box1, box2, eps=1e-6):
+    '''Compute the intersection over union of matched pairs of boxes.
+
+    The box order must be (xmin, ymin, xmax, ymax).
+
+    Args:
+      box1: (tensor) bounding boxes, sized [N,4].
+      box2: (tensor) bounding boxes, sized [N,4].
+
+    Return:
+      (tensor) iou of box1[i] with box2[i], sized [N,].
+    '''
+    lt = torch.max(box1[:,:2], box2[:,:2])  # [N,2]
+    rb = torch.min(box1[:,2:], box2[:,2:])  # [N,2]
+
+    wh = (rb-lt).clamp(min=0)      # [N,2]
+    inter = wh[:,0] * wh[:,1]      # [N,]
+
+    area1 = (box1[:,2]-box1[:,0]) * (box1[:,3]-box1[:,1])  # [N,]
+    area2 = (box2[:,2]-box2[:,0]) * (box2[:,3]-box2[:,1])  # [N,]
+    iou = inter / (area1 + area2 - inter).clamp(min=eps)
+    return iou
+
+
 def batch_box_iou(box1, box2):
     '''Compute the intersection over union of two set of boxes.
 
@@ -179,12 +204,11 @@ def box_soft_nms(boxes, scores, nms_threshold=0.3,
     """
 
     keep = []
-    c_boxes = boxes
     weights = scores.clone()
-    x1 = c_boxes[:, 0]
-    y1 = c_boxes[:, 1]
-    x2 = c_boxes[:, 2]
-    y2 = c_boxes[:, 3]
+    x1 = boxes[:, 0]
+    y1 = boxes[:, 1]
+    x2 = boxes[:, 2]
+    y2 = boxes[:, 3]
     areas = (x2 - x1 + 1) * (y2 - y1 + 1)
     _, order = weights.sort(0, descending=True)
     while order.numel() > 0:
@@ -214,25 +238,92 @@ def box_soft_nms(boxes, scores, nms_threshold=0.3,
         else:
             raise TypeError('Unknown nms mode: %s.' % mode)
 
-        ids_t= (ovr>=nms_threshold).nonzero().squeeze()
+        ids_t = (ovr>=nms_threshold).nonzero().view(-1)
 
-        weights[[order[ids_t+1]]] *= torch.exp(-(ovr[ids_t] * ovr[ids_t]) / sigma)
+        weights[order[ids_t+1]] *= torch.exp(-(ovr[ids_t] * ovr[ids_t]) / sigma)
 
-        ids = (weights[order[1:]] >= soft_threshold).nonzero().squeeze()
-        if ids.numel() == 0:
+        # order stays in indices of boxes (not of the surviving subset)
+        rest = order[1:][weights[order[1:]] >= soft_threshold]
+        if rest.numel() == 0:
             break
-        c_boxes = c_boxes[order[1:]][ids]
-        _, order = weights[order[1:]][ids].sort(0, descending=True)
-        if c_boxes.dim()==1:
-            c_boxes=c_boxes.unsqueeze(0)
-        x1 = c_boxes[:, 0]
-        y1 = c_boxes[:, 1]
-        x2 = c_boxes[:, 2]
-        y2 = c_boxes[:, 3]
-        areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+        _, ids = weights[rest].sort(0, descending=True)
+        order = rest[ids]
 
     return torch.tensor(keep, dtype=torch.long)
 
+def box_soft_nms_from_iou(ious, scores, nms_threshold=0.3, soft_threshold=0.3, sigma=0.5):
+    '''Soft-NMS driven by a precomputed overlap matrix.
+
+    The overlaps are computed once by the caller (and can be shared by all
+    classes of an anchor), each step only rescores one row of it.
+
+    Args:
+      ious: (tensor) pairwise overlaps of the candidates, sized [N,N].
+      scores: (tensor) confidence scores, sized [N,].
+      nms_threshold: (float) overlap above which scores are decayed.
+      soft_threshold: (float) decayed score under which boxes are dropped.
+
+    Returns:
+      keep: (tensor) selected indices.
+    '''
+    weights = scores.clone()
+    order = weights.argsort(descending=True)
+    keep = []
+    while order.numel() > 0:
+        i = order[0]
+        keep.append(i)
+
+        rest = order[1:]
+        ovr = ious[i, rest]
+        decay = torch.exp(-(ovr * ovr) / sigma)
+        weights[rest] *= torch.where(ovr >= nms_threshold, decay, torch.ones_like(decay))
+
+        rest = rest[weights[rest] >= soft_threshold]
+        order = rest[weights[rest].argsort(descending=True)]
+
+    if len(keep) == 0:
+        return torch.zeros((0,), dtype=torch.long, device=scores.device)
+    return torch.stack(keep)
+
+
+def box_fast_nms(bboxes, scores, threshold=0.5, score_threshold=0.05, top_k=200):
+    '''Fast NMS, suppression of all classes in parallel with matrix operations.
+
+    A box is removed if it overlaps any higher scored box of its class,
+    even if that box was itself removed (slightly more aggressive than nms).
+
+    Args:
+      bboxes: (tensor) bounding boxes, sized [N,4].
+      scores: (tensor) per class confidence scores, sized [N,C].
+      threshold: (float) overlap threshold.
+      score_threshold: (float) minimum score of kept boxes.
+      top_k: (int) number of candidates per class.
+
+    Returns:
+      boxes: (tensor) kept boxes, sized [K,4].
+      labels: (tensor) class index of kept boxes, sized [K,].
+      scores: (tensor) scores of kept boxes, sized [K,].
+
+    Reference:
+      https://arxiv.org/abs/1904.02689 (YOLACT)
+    '''
+    scores, idx = scores.t().topk(min(top_k, len(bboxes)), dim=1)  # [C,K] sorted by score
+    boxes = bboxes[idx]  # [C,K,4]
+
+    lt = torch.max(boxes[:, :, None, :2], boxes[:, None, :, :2])  # [C,K,K,2]
+    rb = torch.min(boxes[:, :, None, 2:], boxes[:, None, :, 2:])  # [C,K,K,2]
+    wh = (rb-lt).clamp(min=0)
+    inter = wh[..., 0] * wh[..., 1]  # [C,K,K]
+    areas = (boxes[..., 2]-boxes[..., 0]) * (boxes[..., 3]-boxes[..., 1])  # [C,K]
+    iou = inter / (areas[:, :, None] + areas[:, None, :] - inter)
+
+    # only compare each box to the higher scored ones
+    iou_max = iou.triu(diagonal=1).max(dim=1)[0]  # [C,K]
+    keep = (iou_max <= threshold) & (scores > score_threshold)
+
+    labels = torch.arange(scores.size(0), device=scores.device)[:, None].expand_as(keep)
+    return boxes[keep], labels[keep], scores[keep]
+
 @jit(nopython=True)
 def np_box_nms(bboxes, scores, threshold=0.5):
     '''Non maximum suppression.
@@ -353,6 +444,46 @@ def assign_priors(gt_boxes, gt_labels, corner_form_priors,
     boxes = gt_boxes[best_target_per_prior_index]
 
 
+    return boxes, labels
+
+def assign_priors_batched(gt_boxes, gt_labels, gt_mask, corner_form_priors,
+                          fg_iou_threshold, bg_iou_threshold, allow_low_quality_matches=True):
+    """Assign ground truth boxes and targets to priors, for a padded batch of frames.
+    Args:
+        gt_boxes (num_frames, max_targets, 4): padded ground truth boxes.
+        gt_labels (num_frames, max_targets): padded labels of targets.
+        gt_mask (num_frames, max_targets): True for real targets, False for padding.
+        priors (num_priors, 4): corner form priors
+    Returns:
+        boxes (num_frames, num_priors, 4): real values for priors.
+        labels (num_frames, num_priors): labels for priors.
+    """
+    # size: num_frames x num_priors x max_targets
+    ious = batch_box_iou(corner_form_priors, gt_boxes)
+    ious = ious.masked_fill(~gt_mask[:, None, :], -1)
+    # size: num_frames x num_priors
+    best_target_per_prior, best_target_per_prior_index = ious.max(2)
+
+    if allow_low_quality_matches:
+        # size: num_frames x max_targets
+        best_prior_per_target_index = ious.argmax(1)
+        frames = torch.arange(len(gt_boxes), device=gt_boxes.device)
+        # loop over targets (few) rather than frames, later targets win like in assign_priors
+        for target_index in range(gt_boxes.shape[1]):
+            valid = frames[gt_mask[:, target_index]]
+            prior_index = best_prior_per_target_index[valid, target_index]
+            best_target_per_prior_index[valid, prior_index] = target_index
+            best_target_per_prior[valid, prior_index] = 2
+
+    labels = torch.gather(gt_labels, 1, best_target_per_prior_index)
+
+    mask = (best_target_per_prior > bg_iou_threshold) * (best_target_per_prior < fg_iou_threshold)
+
+    labels[mask] = -1
+    labels[best_target_per_prior < bg_iou_threshold] = 0  # the background id
+    index = best_target_per_prior_index[..., None].expand(*best_target_per_prior_index.shape, 4)
+    boxes = torch.gather(gt_boxes, 1, index)
+
     return boxes, labels
 
 def assign_priors_custom(gt_boxes, corner_form_priors, allow_low_quality_matches=True):
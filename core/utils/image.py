@@ -5,6 +5,7 @@ from __future__ import print_function
 import numpy as np
 import cv2
 import random
+from numba import jit, prange
 
 
 def flip(img):
@@ -234,16 +235,30 @@ def color_aug(data_rng, image, eig_val, eig_vec):
     lighting_(data_rng, image, 0.1, eig_val, eig_vec)
 
 
+def rodrigues(rvec):
+    """rotation matrix of an axis-angle vector (same as cv2.Rodrigues(rvec)[0], without the binding overhead)"""
+    rvec = np.asarray(rvec, dtype=np.float64).reshape(3)
+    theta = np.sqrt(rvec.dot(rvec))
+    if theta < 1e-12:
+        return np.eye(3)
+    kx, ky, kz = rvec / theta
+    k = np.array([[0, -kz, ky],
+                  [kz, 0, -kx],
+                  [-ky, kx, 0]])
+    return np.eye(3) + np.sin(theta) * k + (1 - np.cos(theta)) * k.dot(k)
+
+
 def computeC2MC1(R_0to1, tvec_0to1, R_0to2, tvec_0to2):
     R_1to2 = R_0to2.dot(R_0to1.T)
     tvec_1to2 = R_0to2.dot(-R_0to1.T.dot(tvec_0to1)) + tvec_0to2
     return R_1to2, tvec_1to2
 
 def generate_homography(rvec1, tvec1, rvec2, tvec2, nt, K, Kinv, d):
-    R_0to1 = cv2.Rodrigues(rvec1)[0].transpose()
+    """per-frame homography of the plane nt, d seen from pose 2 (reference of PlanarVoyage.trajectory)"""
+    R_0to1 = rodrigues(rvec1).transpose()
     tvec_0to1 = np.dot(-R_0to1, tvec1.reshape(3, 1))
 
-    R_0to2 = cv2.Rodrigues(rvec2)[0].transpose()
+    R_0to2 = rodrigues(rvec2).transpose()
     tvec_0to2 = np.dot(-R_0to2, tvec2.reshape(3, 1))
 
     #view 0to2
@@ -259,10 +274,55 @@ def generate_homography(rvec1, tvec1, rvec2, tvec2, nt, K, Kinv, d):
     return G_0to2
 
 
+# no 'ninf'/'nnan' fast-math flags: the default bounds and min/max seeds are infinite
+@jit(nopython=True, parallel=True, fastmath={'reassoc', 'contract', 'arcp'})
+def normalize_(arr, lo=-np.inf, hi=np.inf):
+    """in place: clip arr to [lo, hi] and min-max normalize it to [0, 1], in two passes"""
+    flat = arr.reshape(-1)
+    vmin, vmax = np.inf, -np.inf
+    for i in prange(flat.size):
+        v = min(max(flat[i], lo), hi)
+        vmin = min(vmin, v)
+        vmax = max(vmax, v)
+    scale = 1.0 / (vmax - vmin)
+    for i in prange(flat.size):
+        flat[i] = (min(max(flat[i], lo), hi) - vmin) * scale
+    return arr
+
+
+@jit(nopython=True, parallel=True)
+def mean_std(arr, num_chunks=64):
+    """mean and (population) std of a C-contiguous arr in one pass: Welford per chunk, merged serially"""
+    flat = arr.reshape(-1)
+    n = flat.size
+    step = (n + num_chunks - 1) // num_chunks
+    counts = np.zeros(num_chunks)
+    means = np.zeros(num_chunks)
+    m2s = np.zeros(num_chunks)
+    for c in prange(num_chunks):
+        mean, m2, k = 0.0, 0.0, 0
+        for i in range(c * step, min(n, (c + 1) * step)):
+            k += 1
+            d = flat[i] - mean
+            mean += d / k
+            m2 += d * (flat[i] - mean)
+        counts[c], means[c], m2s[c] = k, mean, m2
+    count, mean, m2 = 0.0, 0.0, 0.0
+    for c in range(num_chunks):
+        if counts[c] == 0:
+            continue
+        total = count + counts[c]
+        d = means[c] - mean
+        mean += d * counts[c] / total
+        m2 += m2s[c] + d * d * count * counts[c] / total
+        count = total
+    return mean, np.sqrt(m2 / count)
+
+
 def viz_diff(diff):
-    diff = diff.clip(diff.mean() - 3 * diff.std(), diff.mean() + 3 * diff.std())
-    diff = (diff - diff.min()) / (diff.max() - diff.min())
-    return diff
+    out = diff.astype(np.result_type(diff.dtype, np.float32), order='C')
+    mean, std = mean_std(out)
+    return normalize_(out, mean - 3 * std, mean + 3 * std)
 
 def gradient(plane, k=3):
     gx, gy = cv2.spatialGradient(plane, k, k)
@@ -279,13 +339,29 @@ def compute_timesurface(img, flow, diff):
         diff = diff.mean(axis=2)
 
     # normalize
-    gxy = (gxy - gxy.min()) / (gxy.max() - gxy.min())
+    gxy = normalize_(gxy)
 
     gflow = (gxy * flow).sum(axis=2)
     time = diff / (1e-7 + gflow)
     return time
 
 
+def homogeneous_grid(height, width):
+    """(H,W,3) float32 pixel coordinates (x, y, 1)"""
+    x, y = np.meshgrid(np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32))
+    return np.stack([x, y, np.ones_like(x)], axis=2)
+
+
+def perspective_maps(homography, grid):
+    """cv2.remap maps equivalent to cv2.warpPerspective(src, homography): dst(x,y) = src(homography^-1 (x,y,1))
+
+    :param grid: (H,W,3) output of homogeneous_grid
+    :return: mapx, mapy (H,W) float32
+    """
+    xyz = grid.dot(np.linalg.inv(homography).T.astype(np.float32))
+    return xyz[..., 0] / xyz[..., 2], xyz[..., 1] / xyz[..., 2]
+
+
 def get_flow(homography, height, width):
     x, y = np.meshgrid(np.linspace(-width/2, width/2, width), np.linspace(-height/2, height/2, height))
     x, y = x[:, :, None], y[:, :, None]
@@ -321,8 +397,10 @@ def flow_viz(flow):
     return rgbImg
 
 
-def moving_average(item, alpha):
-    return (1-alpha)*item + alpha * np.random.randn(*item.shape)
+def moving_average(item, alpha, noise=None):
+    if noise is None:
+        noise = np.random.randn(*item.shape)
+    return (1-alpha)*item + alpha * noise
 
 
 class PlanarVoyage(object):
@@ -336,29 +414,75 @@ class PlanarVoyage(object):
         self.tvec1 = np.array([0, 0, 0], dtype=np.float32)
         self.nt = np.array([0, 0, -1], dtype=np.float32).reshape(1, 3)
 
-        self.rvec_amp = np.random.rand(3) * 0.25
-        self.tvec_amp  = np.random.rand(3) * 0.5
+        self.rvec_amp = np.random.rand(3).astype(np.float32) * 0.25
+        self.tvec_amp  = np.random.rand(3).astype(np.float32) * 0.5
 
-        self.rvec_speed = np.random.choice([1e-1,1e-2,1e-3])
-        self.tvec_speed = np.random.choice([1e-1, 1e-2, 1e-3])
+        self.rvec_speed = np.float32(np.random.choice([1e-1,1e-2,1e-3]))
+        self.tvec_speed = np.float32(np.random.choice([1e-1, 1e-2, 1e-3]))
 
         self.rvec_amp[2] = 0.0
 
-        self.tshift = np.random.randn(3)
-        self.rshift = np.random.randn(3)
+        self.tshift = np.random.randn(3).astype(np.float32)
+        self.rshift = np.random.randn(3).astype(np.float32)
         self.d = 1
         self.time = 0
 
-    def __call__(self):
-        self.tshift = moving_average(self.tshift, 1e-4)
-        self.rshift = moving_average(self.rshift, 1e-4)
-        rvec2 = self.rvec_amp * np.sin(self.time * self.rvec_speed + self.rshift)
-        tvec2 = self.tvec_amp * np.sin(self.time * self.tvec_speed + self.tshift)
-        G_0to2 = generate_homography(self.rvec1, self.tvec1, rvec2, tvec2, self.nt, self.K, self.Kinv, self.d)
-        G_0to2 /= G_0to2[2,2]
-        self.time += 1
+        # rvec1 = tvec1 = 0: G_0to2 = K (R_0to2 - tvec_0to2 nt / d) Kinv = K (R_0to2 Kinv - tvec_0to2 (nt Kinv / d))
+        self.nt_Kinv_d = self.nt.dot(self.Kinv) / self.d
+
+        # gaussian noise of the shifts drawn by blocks (seeded from the global state)
+        self.rng = np.random.default_rng(np.random.randint(2**31))
+        self.noise = np.empty((4096, 2, 3), dtype=np.float32)
+        self.noise_idx = len(self.noise)
+
+    def next_noise(self, num):
+        """(num,2,3) gaussian samples, consumed from the preallocated block"""
+        out = np.empty((num, 2, 3), dtype=np.float32)
+        i = 0
+        while i < num:
+            if self.noise_idx == len(self.noise):
+                self.rng.standard_normal(dtype=np.float32, out=self.noise)
+                self.noise_idx = 0
+            n = min(num - i, len(self.noise) - self.noise_idx)
+            out[i:i+n] = self.noise[self.noise_idx:self.noise_idx+n]
+            self.noise_idx += n
+            i += n
+        return out
+
+    def trajectory(self, num):
+        """next num homographies (num,3,3), same as num calls, with vectorized numpy ops"""
+        alpha = np.float32(1e-4)
+        beta = 1 - alpha
+        # unrolled moving average: shift_k = beta^k (shift_0 + alpha * sum_{j<=k} beta^-j noise_j)
+        k = np.arange(1, num + 1, dtype=np.float32)[:, None]
+        noise = self.next_noise(num)
+        tshift = beta**k * (self.tshift + alpha * np.cumsum(beta**-k * noise[:, 0], axis=0))
+        rshift = beta**k * (self.rshift + alpha * np.cumsum(beta**-k * noise[:, 1], axis=0))
+        self.tshift, self.rshift = tshift[-1], rshift[-1]
+
+        time = np.arange(self.time, self.time + num, dtype=np.float32)[:, None]
+        rvec2 = self.rvec_amp * np.sin(time * self.rvec_speed + rshift)
+        tvec2 = self.tvec_amp * np.sin(time * self.tvec_speed + tshift)
+
+        # batched rodrigues
+        theta = np.sqrt((rvec2**2).sum(axis=1))
+        axis = rvec2 / np.where(theta < 1e-12, 1, theta)[:, None]
+        skew = np.zeros((num, 3, 3), dtype=np.float32)
+        skew[:, 0, 1], skew[:, 0, 2], skew[:, 1, 2] = -axis[:, 2], axis[:, 1], -axis[:, 0]
+        skew -= skew.transpose(0, 2, 1)
+        R = np.eye(3, dtype=np.float32) + np.sin(theta)[:, None, None] * skew + \
+            (1 - np.cos(theta))[:, None, None] * np.matmul(skew, skew)
+
+        R_0to2 = R.transpose(0, 2, 1)
+        tvec_0to2 = np.matmul(-R_0to2, tvec2[..., None])
+        G_0to2 = np.matmul(self.K, np.matmul(R_0to2, self.Kinv) - np.matmul(tvec_0to2, self.nt_Kinv_d))
+        G_0to2 /= G_0to2[:, 2:, 2:]
+        self.time += num
         return G_0to2
 
+    def __call__(self):
+        return self.trajectory(1)[0]
+
 
 def wrap_boxes(boxes, height, width):
     """repeats boxes in 8 cells around the image
@@ -58,7 +58,7 @@ def show_multimodal(inside, boundaries, outside, semantics):
     ibo = i_xor_b_and_o(inside, boundaries, outside)
     contours, hierarchy = cv2.findContours(ibo.astype(np.uint8), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
 
-    ibo = ibo[..., None].repeat(3, 2).astype(np.uint8) * 255
+    ibo = cv2.cvtColor(ibo.astype(np.uint8) * 255, cv2.COLOR_GRAY2BGR)
     colors = cv2.applyColorMap(np.arange(0, 255).astype(np.uint8), cv2.COLORMAP_RAINBOW)
     colors = [tuple(*item) for item in colors.tolist()]
     random.shuffle(colors)
@@ -44,7 +44,7 @@ def make_single_channel_display(img, low=None, high=None):
         img = ((img - img.min()) / (img.max() - img.min()) * 255).astype(np.uint8)
     else:
         img = ((img+1)/2*255).astype(np.uint8)
-    img = (img.astype(np.uint8))[..., None].repeat(3, 2)
+    img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
     return img
 
 
@@ -16,6 +16,15 @@ from datasets.coco_wrapper import COCO2 as COCO
 from core.utils import vis, opts, image as imutil, data_augment as da
 import cv2
 
+# warps run on all threads by default: keep to physical cores (smt oversubscribes)
+cv2.setUseOptimized(True)
+cv2.setNumThreads(max(1, (os.cpu_count() or 2) // 2))
+
+
+def cv2_worker_init(worker_id):
+    """single-threaded opencv in dataloader workers: the workers already share the cores"""
+    cv2.setNumThreads(1)
+
 
 
 class CocoDataset(Dataset):
@@ -194,9 +203,54 @@ class CameraMotion(object):
     """Simulate a camera motion in front of the image plane
        This Allows to make a fake video
     """
-    def __init__(self, max_time=1):
+    def __init__(self, max_time=1, device=None, remap_every=1):
+        """
+        :param max_time: number of frames
+        :param device: if set (e.g 'cuda'), warps with kornia on this device instead of cv2
+        (all frames of a video in one call; with cuda, use num_workers=0 or a 'spawn' start method)
+        :param remap_every: if > 1, exact warp maps only every remap_every frames (and last one),
+        linearly interpolated in between (approximate images, boxes stay exact)
+        """
         self.max_time = max_time
         self.border_mode = cv2.BORDER_CONSTANT
+        self.device = device
+        self.remap_every = remap_every
+        self._grids = {}
+
+    def warp_remap(self, image, homographies):
+        """cv2.remap of image (H,W,C) by homographies (T,3,3) with keyframe maps, returns (T,H,W,C)"""
+        height, width = image.shape[:2]
+        if (height, width) not in self._grids:
+            self._grids[(height, width)] = imutil.homogeneous_grid(height, width)
+        grid = self._grids[(height, width)]
+
+        num = len(homographies)
+        keys = list(range(0, num - 1, self.remap_every)) + [num - 1]
+        maps = {k: imutil.perspective_maps(homographies[k], grid) for k in keys}
+        out = np.empty((num,) + image.shape, dtype=image.dtype)
+        for a, b in zip(keys[:-1], keys[1:]):
+            for t in range(a, b):
+                if t == a:
+                    mapx, mapy = maps[a]
+                else:
+                    w = (t - a) / (b - a)
+                    mapx = (1 - w) * maps[a][0] + w * maps[b][0]
+                    mapy = (1 - w) * maps[a][1] + w * maps[b][1]
+                cv2.remap(image, mapx, mapy, cv2.INTER_LINEAR, dst=out[t], borderMode=self.border_mode)
+        cv2.remap(image, *maps[num - 1], cv2.INTER_LINEAR, dst=out[num - 1], borderMode=self.border_mode)
+        return out
+
+    def use_device(self):
+        # kornia pads with zeros only
+        return self.device is not None and self.border_mode == cv2.BORDER_CONSTANT
+
+    def warp_on_device(self, image, homographies):
+        """warps image (H,W,C) by all homographies (T,3,3) in one batched call, returns (T,H,W,C)"""
+        from kornia.geometry.transform import warp_perspective
+        src = torch.from_numpy(image).to(self.device).permute(2, 0, 1)[None].float()
+        G = torch.from_numpy(homographies).to(src)
+        out = warp_perspective(src.expand(len(G), -1, -1, -1), G, src.shape[-2:], align_corners=True)
+        return out.permute(0, 2, 3, 1).cpu().numpy()
 
     def __call__(self, sample):
         image = sample['img']
@@ -208,24 +262,34 @@ class CameraMotion(object):
         if self.border_mode == cv2.BORDER_WRAP:
             boxes = imutil.wrap_boxes(boxes, height, width)
 
-        imseq = []
+        homographies = voyage.trajectory(self.max_time)
+        warped = None
+        if self.use_device():
+            warped = self.warp_on_device(image, homographies)
+        elif self.remap_every > 1:
+            warped = self.warp_remap(image, homographies)
+
+        if warped is None:
+            # written in place, frame by frame
+            warped = np.empty((self.max_time,) + image.shape, dtype=image.dtype)
+            for t, G_0to2 in enumerate(homographies):
+                cv2.warpPerspective(image, G_0to2, dsize=(width, height), dst=warped[t], flags=cv2.INTER_LINEAR,
+                                    borderMode=self.border_mode)
+
         boxseq = []
-        for _ in range(self.max_time):
-            G_0to2 = voyage()
-            out = cv2.warpPerspective(image, G_0to2, dsize=(width, height), borderMode=self.border_mode)
+        for t, G_0to2 in enumerate(homographies):
             labels = boxes[:, 4:5]
             tboxes = imutil.cv2_apply_transform_boxes(boxes[:, :4], G_0to2)
             tboxes = imutil.clamp_boxes(tboxes, height, width)
             tboxes = np.concatenate([tboxes, labels], 1)
             tboxes = imutil.discard_too_small(tboxes, 10)
-            imseq.append(out[None])
             boxseq.append(tboxes)
 
         if self.max_time == 1:
-            sample['img'] = imseq[0][0]
+            sample['img'] = warped[0]
             sample['annot'] = boxseq[0]
         else:
-            sample['img'] = np.concatenate(imseq)
+            sample['img'] = warped
             sample['annot'] = boxseq
         return sample
 
@@ -418,18 +482,20 @@ def make_still_coco(root_dir, batchsize, num_workers, fixed_size=True):
 
     if fixed_size:
         train_loader = DataLoader(dataset_train, num_workers=num_workers, batch_size=batchsize,
-                                collate_fn=collater, pin_memory=True)
+                                collate_fn=collater, pin_memory=True, worker_init_fn=cv2_worker_init)
 
         val_loader = DataLoader(dataset_val, num_workers=num_workers, batch_size=batchsize,
-                                collate_fn=collater, pin_memory=True)
+                                collate_fn=collater, pin_memory=True, worker_init_fn=cv2_worker_init)
     else:
         train_sampler = AspectRatioBasedSampler(dataset_train, batch_size=batchsize, drop_last=False)
         train_loader = DataLoader(dataset_train, num_workers=num_workers, 
-                                collate_fn=collater, batch_sampler=train_sampler, pin_memory=True)
+                                collate_fn=collater, batch_sampler=train_sampler, pin_memory=True,
+                                worker_init_fn=cv2_worker_init)
 
         val_sampler = AspectRatioBasedSampler(dataset_val, batch_size=batchsize, drop_last=False)
         val_loader = DataLoader(dataset_val, num_workers=num_workers, 
-                                collate_fn=collater, batch_sampler=val_sampler, pin_memory=True)
+                                collate_fn=collater, batch_sampler=val_sampler, pin_memory=True,
+                                worker_init_fn=cv2_worker_init)
     # ensure preallocated cuda memory
     # train_loader = opts.WrapperSingleAllocation(train_loader, storage_size=batchsize*3*512*512)
     # val_loader = opts.WrapperSingleAllocation(val_loader, storage_size=batchsize*3*512*512)                   
@@ -443,10 +509,10 @@ def make_moving_coco(root_dir, batchsize, num_workers, num_tbins=5):
                               transform=transforms.Compose([Normalizer(), Resizer(fixed_size=True), CameraMotion(num_tbins)]))
 
     train_loader = DataLoader(dataset_train, num_workers=num_workers, batch_size=batchsize,
-                                collate_fn=video_collater, pin_memory=True)
+                                collate_fn=video_collater, pin_memory=True, worker_init_fn=cv2_worker_init)
 
     val_loader = DataLoader(dataset_val, num_workers=num_workers, batch_size=batchsize,
-                            collate_fn=video_collater, pin_memory=True)
+                            collate_fn=video_collater, pin_memory=True, worker_init_fn=cv2_worker_init)
             
     return train_loader, val_loader, len(dataset_train.labels)
 
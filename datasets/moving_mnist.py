@@ -10,8 +10,10 @@ import torch
 import numpy as np
 import random
 import cv2
+from numba import jit
 import datasets.moving_box as toy
 from datasets.multistreamer import MultiStreamer
+from torch.utils.data import IterableDataset, DataLoader
 
 from torchvision import datasets, transforms
 from functools import partial 
@@ -31,10 +33,42 @@ TEST_DATASET = datasets.MNIST('../data', train=False, download=True,
                                        ]))
 
 
+@jit(nopython=True)
+def paste_max(img, thumbnail, x1, y1):
+    """img[y1:y2, x1:x2] = max(img[y1:y2, x1:x2], thumbnail), in place"""
+    h, w, c = thumbnail.shape
+    for y in range(h):
+        for x in range(w):
+            for k in range(c):
+                v = thumbnail[y, x, k]
+                if v > img[y1 + y, x1 + x, k]:
+                    img[y1 + y, x1 + x, k] = v
+
+
+def pack_digits(dataset, threshold=0.45):
+    """all digits of a MNIST dataset as one uint8 array [N,28,28],
+    with labels, per digit min/max and tight box [x1,y1,x2,y2] of the min-max normalized digit > threshold
+    (the Normalize transform is affine, so the raw images give the same normalized digits)"""
+    digits = dataset.data.numpy()
+    labels = dataset.targets.numpy()
+    vmin = digits.min(axis=(1, 2)).astype(np.float32)
+    vmax = digits.max(axis=(1, 2)).astype(np.float32)
+    mask = digits > (vmin + threshold * (vmax - vmin))[:, None, None]
+    rows, cols = mask.any(axis=2), mask.any(axis=1)
+    y1, y2 = rows.argmax(axis=1), rows.shape[1] - 1 - rows[:, ::-1].argmax(axis=1)
+    x1, x2 = cols.argmax(axis=1), cols.shape[1] - 1 - cols[:, ::-1].argmax(axis=1)
+    boxes = np.stack([x1, y1, x2, y2], axis=1)
+    return digits, labels, vmin, vmax, boxes
+
+
+TRAIN_DIGITS = pack_digits(TRAIN_DATASET)
+TEST_DIGITS = pack_digits(TEST_DATASET)
+
+
 class MovingMnistAnimation(toy.Animation):
     def __init__(self, h=128, w=128, c=3, max_stop=15,
                 max_objects=2, anim_id = 0, train=True, mode='none'):
-        self.dataset_ = TRAIN_DATASET if train else TEST_DATASET
+        self.digits_ = TRAIN_DIGITS if train else TEST_DIGITS
         self.label_offset = 1
         self.channels = c
         np.random.seed(anim_id)
@@ -44,27 +78,36 @@ class MovingMnistAnimation(toy.Animation):
 
     def reset(self):
         super(MovingMnistAnimation, self).reset()
+        digits, labels, vmin, vmax, digit_boxes = self.digits_
         for i in range(len(self.objects)):
-            idx = np.random.randint(0, len(self.dataset_))
-            x, y = self.dataset_[idx]
-            self.objects[i].class_id = y
+            idx = np.random.randint(0, len(digits))
+            self.objects[i].class_id = int(labels[idx])
             self.objects[i].idx = idx
-            img = x.numpy()[0]
-            img = (img-img.min())/(img.max()-img.min())
-            abs_img = np.abs(img)
-            y, x = np.where(abs_img > 0.45)
-            x1, x2 = np.min(x), np.max(x)
-            y1, y2 = np.min(y), np.max(y)
-            self.objects[i].img = np.repeat(img[y1:y2, x1:x2][...,None], self.channels, 2)
+            x1, y1, x2, y2 = digit_boxes[idx]
+            img = (digits[idx, y1:y2, x1:x2].astype(np.float32) - vmin[idx]) / (vmax[idx] - vmin[idx])
+            self.objects[i].img = np.repeat(img[...,None], self.channels, 2)
+            self.objects[i].resize_cache = {}
+
+    def get_thumbnail(self, object, width, height):
+        """resized digit, cached per size (boxes mostly move, they are rarely rescaled)"""
+        thumbnail = object.resize_cache.get((width, height))
+        if thumbnail is None:
+            if len(object.resize_cache) > 64:
+                object.resize_cache.clear()
+            thumbnail = cv2.resize(object.img, (width, height), interpolation=cv2.INTER_LINEAR)
+            if thumbnail.ndim == 2:
+                thumbnail = thumbnail[..., None]
+            object.resize_cache[(width, height)] = thumbnail
+        return thumbnail
 
     def run(self):
         self.img[...] = 0
         boxes = np.zeros((len(self.objects), 5), dtype=np.float32)
         for i, object in enumerate(self.objects):
             x1, y1, x2, y2 = object.run()
-            boxes[i] = np.array([x1, y1, x2, y2, object.class_id + self.label_offset])
-            thumbnail = cv2.resize(object.img, (x2-x1, y2-y1), cv2.INTER_LINEAR)
-            self.img[y1:y2, x1:x2] = np.maximum(self.img[y1:y2, x1:x2], thumbnail)
+            boxes[i] = x1, y1, x2, y2, object.class_id + self.label_offset
+            thumbnail = self.get_thumbnail(object, x2-x1, y2-y1)
+            paste_max(self.img, thumbnail, x1, y1)
         output = self.img 
         if self.mode == 'diff':
             output = self.run_diff()
@@ -74,10 +117,15 @@ class MovingMnistAnimation(toy.Animation):
         output = self.img
         if self.prev_img is None:
             output[...] = 0
+            self.prev_img = np.zeros(self.img.shape, dtype=np.float32)
+            self.diff_img = np.zeros(self.img.shape, dtype=np.float32)
         else:
-            output = self.prev_img - self.img
-            output = (output-output.min())/(output.max()-output.min())
-        self.prev_img = self.img.copy().astype(np.float32)
+            output = np.subtract(self.prev_img, self.img, out=self.diff_img)
+            vmin, vmax = output.min(), output.max()
+            output -= vmin
+            output /= (vmax - vmin)
+        # the current frame becomes the previous one, its old buffer is redrawn by the next run()
+        self.prev_img, self.img = self.img, self.prev_img
         return output
 
 class MnistEnv(object):
@@ -98,30 +146,35 @@ class MnistEnv(object):
 
     def next(self, arrays):
         tbins = arrays.shape[1]
-        all_boxes = []
         reset = self.step > self.max_steps
         if reset: 
             self.step = 0
             for env in self.envs:
                 env.reset()    
+        # boxes padded to max_objects per frame, with their count
+        max_objects = max([env.max_objects for env in self.envs], default=0)
+        all_boxes = np.zeros((len(self.envs), tbins, max_objects, 5), dtype=np.float32)
+        all_counts = np.zeros((len(self.envs), tbins), dtype=np.int64)
         for i, env in enumerate(self.envs):
-            env_boxes = []
             for t in range(tbins):
                 observation, boxes = env.run()  
-                arrays[i, t] = observation   
-                env_boxes.append(boxes)
-            all_boxes.append(env_boxes)
+                arrays[i, t] = observation.transpose(2, 0, 1)  # hwc -> chw
+                all_boxes[i, t, :len(boxes)] = boxes
+                all_counts[i, t] = len(boxes)
 
         self.step += tbins
-        return {'boxes': all_boxes, 'resets': [reset]*len(self.envs)}
+        return {'boxes': list(all_boxes), 'counts': list(all_counts), 'resets': [reset]*len(self.envs)}
 
 
 def collate_fn(data):
-    #permute NTCHW - TNCHW
-    batch, boxes, resets = data['data'], data['boxes'], data['resets']
-    batch = torch.from_numpy(batch).permute(1,0,4,2,3).contiguous()
+    #permute NTCHW - TNCHW (workers already write chw frames)
+    batch, boxes, counts, resets = data['data'], data['boxes'], data['counts'], data['resets']
+    batch = torch.from_numpy(batch).transpose(0, 1).contiguous()
     t, n = batch.shape[:2]
-    boxes = [[torch.from_numpy(boxes[i][t]) for i in range(n)] for t in range(t)]
+    # one tensor for all padded boxes, per frame lists are views of it
+    boxes = torch.from_numpy(np.stack(boxes)).permute(1,0,2,3).contiguous()
+    counts = np.stack(counts).T
+    boxes = [[boxes[t, i, :counts[t, i]] for i in range(n)] for t in range(t)]
     resets = 1-torch.FloatTensor(resets)
     resets = resets[:,None,None,None]
     return {'data': batch, 'boxes': boxes, 'resets': resets}
@@ -130,7 +183,7 @@ def collate_fn(data):
 def make_moving_mnist(train_iter=10, test_iter=10, tbins=10, num_workers=1, batchsize=8, start_epoch=0,
     height=256, width=256):
     height, width, cin = height, width, 3
-    array_dim = (tbins, height, width, cin)
+    array_dim = (tbins, cin, height, width)
     env_train = partial(MnistEnv, niter=train_iter, h=height, w=width, c=cin, train=True)
     env_val = partial(MnistEnv, niter=test_iter, h=height, w=width, c=cin, train=False)
     train_dataset = MultiStreamer(env_train, array_dim, batchsize=batchsize, max_q_size=4, 
@@ -142,7 +195,58 @@ def make_moving_mnist(train_iter=10, test_iter=10, tbins=10, num_workers=1, batc
 
 
 
-def show_mnist(train_iter=10, test_iter=10, tbins=10, num_workers=1, batchsize=8):
+class MnistStream(IterableDataset):
+    """
+    MnistEnv as an IterableDataset yielding whole collated batches,
+    the same videos stay in the same batch slots from one batch to the next
+    """
+    def __init__(self, make_env, array_dim, batchsize, epoch=0):
+        self.make_env = make_env
+        self.array_dim = array_dim
+        self.batchsize = batchsize
+        self.epoch = epoch
+        dataset = make_env(proc_id=0, num_procs=0, num_envs=0)
+        self.max_iter = dataset.max_iter
+        self.labelmap = dataset.labelmap
+        self.label_offset = dataset.label_offset
+
+    def __len__(self):
+        return self.max_iter
+
+    def reset(self):
+        pass
+
+    def __iter__(self):
+        group = self.make_env(proc_id=1, num_procs=1, num_envs=self.batchsize, epoch=self.epoch)
+        arrays = np.zeros((self.batchsize, *self.array_dim), dtype=np.float32)
+        for _ in range(group.max_iter):
+            info = group.next(arrays)
+            info['data'] = arrays
+            yield collate_fn(info)
+        self.epoch += 1
+
+
+def make_moving_mnist_dataloader(train_iter=10, test_iter=10, tbins=10, batchsize=8, start_epoch=0,
+    height=256, width=256, pin_memory=True):
+    """
+    Same streams as make_moving_mnist, generated by a persistent torch DataLoader worker
+    (pinned memory, prefetching). A single worker per loader: with several,
+    the DataLoader would alternate batches between workers and break the temporal coherence of the slots.
+    """
+    height, width, cin = height, width, 3
+    array_dim = (tbins, cin, height, width)
+    env_train = partial(MnistEnv, niter=train_iter, h=height, w=width, c=cin, train=True)
+    env_val = partial(MnistEnv, niter=test_iter, h=height, w=width, c=cin, train=False)
+    make_loader = partial(DataLoader, batch_size=None, num_workers=1, persistent_workers=True,
+                          pin_memory=pin_memory, prefetch_factor=4)
+    train_dataset = make_loader(MnistStream(env_train, array_dim, batchsize, epoch=start_epoch))
+    test_dataset = make_loader(MnistStream(env_val, array_dim, batchsize, epoch=100))
+    classes = 10
+    return train_dataset, test_dataset, classes
+
+
+def show_mnist(train_iter=10, test_iter=10, tbins=10, num_workers=1, batchsize=8, render=True):
+    """displays the moving mnist batches, render=False only times the data loading"""
     dataloader, _, _ = make_moving_mnist(train_iter, test_iter, tbins, num_workers, batchsize)
     show_batchsize = dataloader.batchsize
 
@@ -159,20 +263,20 @@ def show_mnist(train_iter=10, test_iter=10, tbins=10, num_workers=1, batchsize=8
             batch, targets = data['data'], data['boxes']
             height, width = batch.shape[-2], batch.shape[-1]
             runtime = time.time() - start
-            for t in range(10):
-                grid[...] = 0
-                for n in range(dataloader.batchsize):
-                    img = batch[t,n].permute(1, 2, 0).cpu().numpy()*255
-                    boxes = targets[t][n].numpy() 
-                    boxes = boxes.astype(np.int32)
-                    bboxes = boxarray_to_boxes(boxes[:, :4], boxes[:, 4]-1, dataloader.dataset.labelmap)
-                    img = draw_bboxes(img, bboxes) 
-                    grid[n//ncols, n%ncols] = img
-                im = grid.swapaxes(1, 2).reshape(nrows * height, ncols * width, 3)
-                cv2.imshow('dataset', im)
-                key = cv2.waitKey(5)
-                if key == 27:
-                    break
+            if render:
+                for t in range(len(batch)):
+                    for n in range(dataloader.batchsize):
+                        img = batch[t,n].permute(1, 2, 0).cpu().numpy()*255
+                        boxes = targets[t][n].numpy() 
+                        boxes = boxes.astype(np.int32)
+                        bboxes = boxarray_to_boxes(boxes[:, :4], boxes[:, 4]-1, dataloader.dataset.labelmap)
+                        img = draw_bboxes(img, bboxes) 
+                        grid[n//ncols, n%ncols] = img
+                    im = grid.swapaxes(1, 2).reshape(nrows * height, ncols * width, 3)
+                    cv2.imshow('dataset', im)
+                    key = cv2.waitKey(5)
+                    if key == 27:
+                        break
             
             
             sys.stdout.write('\rtime: %f' % (runtime))
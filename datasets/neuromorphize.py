@@ -15,7 +15,8 @@ def cv2_normalize(im):
 class Neuromorphizer(nn.Module):
     def __init__(self, height, width, video_fps, 
                     refractory_period_us=0, threshold=0, 
-                    p_fix_pattern_noise=0.001, max_period_noise=10, max_tbins=100, dynamic_threshold=True):
+                    p_fix_pattern_noise=0.001, max_period_noise=10, max_tbins=100, dynamic_threshold=True,
+                    verbose=False):
         super(Neuromorphizer, self).__init__()
         self.height = height
         self.width = width
@@ -25,7 +26,8 @@ class Neuromorphizer(nn.Module):
         self.register_buffer('timesurface', torch.zeros((height,width), dtype=torch.short))
 
         self.refractory_period_us = refractory_period_us
-        print('ref: ', self.refractory_period_us, ' delta_t: ', self.delta_t_us)
+        if verbose:
+            print('ref: ', self.refractory_period_us, ' delta_t: ', self.delta_t_us)
         self.threshold = threshold 
         self.t_us = 0
 
@@ -54,29 +56,22 @@ class Neuromorphizer(nn.Module):
                 ready = self.timesurface <= min_time
                 diff = diff * ready
 
-            on = (diff > self.threshold)  
-            off = diff < self.threshold
             zero = diff.abs() <= self.threshold
-
-            non_zero = ~zero
-
-            self.diffs[i][on] = 255
-            self.diffs[i][off] = 0
-            self.diffs[i][zero] = 127  
-
-            self.state[non_zero] = i_t[non_zero]
-
-            self.timesurface[non_zero] = cnt
-
             noise_on = self.on_noise[cnt%len(self.on_noise)]
             noise_off = self.off_noise[cnt%len(self.off_noise)]
 
+            # 255 on, 0 off, 127 no event, then fixed pattern noise
+            # (masked_fill/where instead of boolean indexing: no nonzero(), no host sync)
+            events = self.diffs[i]
+            events.copy_(diff > self.threshold).mul_(255)
+            events.masked_fill_(zero, 127).masked_fill_(noise_on, 255).masked_fill_(noise_off, 0)
 
-            self.diffs[i][noise_on] = 255
-            self.diffs[i][noise_off] = 0
+            self.state.copy_(torch.where(zero, self.state, i_t))
+            self.timesurface.masked_fill_(~zero, cnt)
 
             if self.dynamic_threshold:
-                self.threshold = float(i_t.sum().item())/(self.width * self.height * 255) * self.base_threshold 
+                # stays a (0-dim) tensor on the device
+                self.threshold = i_t.sum() / (self.width * self.height * 255.) * self.base_threshold
 
         return self.diffs
 
@@ -117,17 +112,20 @@ class TensorPipeline(object):
                 yield y
 
 
-def neuromorphize(tensor_pipeline, pix2nvs, fltr, viz):
+def neuromorphize(tensor_pipeline, pix2nvs, fltr, viz, verbose=False):
     with torch.no_grad():
         for tensor in tensor_pipeline:
-            start = cuda_tick()
+            # timing synchronizes the device twice per batch: only when asked for
+            if verbose:
+                start = cuda_tick()
             events = pix2nvs(tensor)
             fltrd = fltr(tensor.unsqueeze(1).float())
 
-            end = cuda_tick()
-            rt = end-start
-            freq = (1./rt) * len(tensor)
-            print(freq, ' img/s', ' dt: ', rt)
+            if verbose:
+                end = cuda_tick()
+                rt = end-start
+                freq = (1./rt) * len(tensor)
+                print(freq, ' img/s', ' dt: ', rt)
 
             if viz:
                 event_data = events.cpu().numpy()
@@ -144,7 +142,7 @@ def neuromorphize(tensor_pipeline, pix2nvs, fltr, viz):
                     if key == 27:
                         return
 
-def neuromorphize_video(video_filename, threshold=5, tbins=120, height=480, width=640, seek_frame=0, ref=0, scene_fps=1000, p=0.001, viz=True):
+def neuromorphize_video(video_filename, threshold=5, tbins=120, height=480, width=640, seek_frame=0, ref=0, scene_fps=1000, p=0.001, viz=True, verbose=True):
     """Example of usage of neuromorphizer
 
     Take a OpenCV video & turn it into events
@@ -159,7 +157,8 @@ def neuromorphize_video(video_filename, threshold=5, tbins=120, height=480, widt
                                 p_fix_pattern_noise=p,
                                 threshold=threshold, 
                                 max_period_noise=10,
-                                max_tbins=tbins)
+                                max_tbins=tbins,
+                                verbose=verbose)
     pix2nvs.cuda()
     
     for video_filename in video_filenames:
@@ -172,7 +171,7 @@ def neuromorphize_video(video_filename, threshold=5, tbins=120, height=480, widt
         cv_filter = lambda x:kornia.feature.harris_response(x)
         # cv_filter = lambda x:kornia.feature.gftt_response(x)
         cv_filter = lambda x:kornia.filters.sobel(x)
-        neuromorphize(tensor_pipeline, pix2nvs, cv_filter, viz)
+        neuromorphize(tensor_pipeline, pix2nvs, cv_filter, viz, verbose)
 
     
 if __name__ == '__main__':
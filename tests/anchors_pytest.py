@@ -102,6 +102,20 @@ class TestAnchors(object):
         assert max_cls_diff == 0
         assert cat_diff.abs().max() == 0
 
+    def pytestcase_assign_priors_batched(self):
+        targets = self.init(3, 7, allow_low_quality_matches=True)
+        anchors, anchors_xyxy = self.box_coder(self.fmaps, (self.height, self.width))
+        gt_padded, sizes = box.pack_boxes_list_of_list(targets)
+        gt_boxes, gt_labels = gt_padded[..., :4], gt_padded[..., -1]
+        boxes, labels = box.assign_priors_batched(gt_boxes, gt_labels, gt_labels != -2, anchors_xyxy,
+                                                  self.fg_iou_threshold, self.bg_iou_threshold)
+        for t in range(len(gt_padded)):
+            max_size = sizes[t]
+            boxes_t, labels_t = box.assign_priors(gt_boxes[t, :max_size], gt_labels[t, :max_size].clone(), anchors_xyxy,
+                                                  self.fg_iou_threshold, self.bg_iou_threshold)
+            self.assert_equal(boxes[t], boxes_t)
+            self.assert_equal(labels[t], labels_t)
+
     def one_hot(self, y, num_classes):
         y2 = y.unsqueeze(2)
         fg = (y2 > 0).float()
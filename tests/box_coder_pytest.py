@@ -0,0 +1,50 @@
+"""
+Tests ssd box coder decoding is working correctly.
+"""
+from __future__ import print_function
+from types import SimpleNamespace
+from core.ssd.box_coder import SSDBoxCoder
+from core.utils import box
+import torch
+
+
+class TestSSDBoxCoder(object):
+    """
+    test of ssd box coder class.
+    """
+    def init(self, num_anchors=300, num_classes=4, height=128, width=128, nms_type='soft_nms'):
+        torch.manual_seed(0)
+        ssd_model = SimpleNamespace(steps=[(16, 16)], box_sizes=[32], aspect_ratios=[1], scales=[1],
+                                    fm_sizes=[(height // 16, width // 16)], height=height, width=width)
+        self.box_coder = SSDBoxCoder(ssd_model, nms_type=nms_type)
+        xy = torch.rand(num_anchors, 2) * torch.tensor([width, height])
+        wh = 8 + torch.rand(num_anchors, 2) * 48
+        box_preds = torch.cat([xy, xy + wh], 1)
+        cls_preds = torch.rand(num_anchors, num_classes + 1)
+        return box_preds, cls_preds
+
+    def multiclass_soft_nms_sequential(self, box_preds, cls_preds, score_thresh, nms_thresh):
+        boxes, labels, scores = [], [], []
+        for i in range(cls_preds.shape[1] - 1):
+            score = cls_preds[:, i + 1]
+            mask = score > score_thresh
+            if not mask.any():
+                continue
+            keep = box.box_soft_nms(box_preds[mask], score[mask], nms_thresh)
+            boxes.append(box_preds[mask][keep])
+            labels.append(torch.full((len(keep),), i, dtype=torch.long))
+            scores.append(score[mask][keep])
+        return torch.cat(boxes), torch.cat(labels), torch.cat(scores)
+
+    def pytestcase_soft_nms_per_class(self):
+        """
+        shared overlap template + per-class soft-nms gives the per-class box_soft_nms result
+        """
+        box_preds, cls_preds = self.init()
+        for score_thresh, nms_thresh in [(0.5, 0.45), (0.2, 0.3), (0.8, 0.6)]:
+            boxes, labels, scores = self.box_coder.multiclass_nms(box_preds, cls_preds, score_thresh, nms_thresh)
+            boxes2, labels2, scores2 = self.multiclass_soft_nms_sequential(box_preds, cls_preds,
+                                                                          score_thresh, nms_thresh)
+            assert (labels == labels2).all()
+            assert (boxes == boxes2).all()
+            assert (scores == scores2).all()
@@ -0,0 +1,56 @@
+"""
+Tests planar voyage homographies are working correctly.
+"""
+from __future__ import print_function
+import copy
+import numpy as np
+from core.utils import image as imutil
+
+
+class TestPlanarVoyage(object):
+    """
+    test of planar voyage class against the per-frame generate_homography recursion.
+    """
+    def init(self, height=240, width=320, seed=0):
+        np.random.seed(seed)
+        voyage = imutil.PlanarVoyage(height, width)
+        reference = copy.deepcopy(voyage)
+        return voyage, reference
+
+    def reference_step(self, voyage):
+        noise = voyage.next_noise(1)[0]
+        voyage.tshift = imutil.moving_average(voyage.tshift, 1e-4, noise[0])
+        voyage.rshift = imutil.moving_average(voyage.rshift, 1e-4, noise[1])
+        rvec2 = voyage.rvec_amp * np.sin(voyage.time * voyage.rvec_speed + voyage.rshift)
+        tvec2 = voyage.tvec_amp * np.sin(voyage.time * voyage.tvec_speed + voyage.tshift)
+        G_0to2 = imutil.generate_homography(voyage.rvec1, voyage.tvec1, rvec2, tvec2, voyage.nt,
+                                            voyage.K, voyage.Kinv, voyage.d)
+        G_0to2 /= G_0to2[2, 2]
+        voyage.time += 1
+        return G_0to2
+
+    def pytestcase_closed_form_homography(self):
+        """
+        closed form of a single step is generate_homography with rvec1 = tvec1 = 0
+        """
+        for seed in range(10):
+            voyage, reference = self.init(seed=seed)
+            for _ in range(5):
+                np.testing.assert_allclose(voyage(), self.reference_step(reference), rtol=1e-4, atol=1e-4)
+
+    def pytestcase_trajectory(self):
+        """
+        unrolled moving average + batched rodrigues give the same homographies as successive steps,
+        including windows that cross the refill of the noise block
+        """
+        for seed in range(3):
+            voyage, reference = self.init(seed=seed)
+            for num in [1, 7, 300, 3900]:
+                homographies = voyage.trajectory(num)
+                assert homographies.shape == (num, 3, 3)
+                assert homographies.dtype == np.float32
+                expected = np.stack([self.reference_step(reference) for _ in range(num)])
+                np.testing.assert_allclose(homographies, expected, rtol=1e-4, atol=1e-4)
+            np.testing.assert_allclose(voyage.tshift, reference.tshift, rtol=1e-4, atol=1e-5)
+            np.testing.assert_allclose(voyage.rshift, reference.rshift, rtol=1e-4, atol=1e-5)
+            assert voyage.time == reference.time